@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+	A module that generates synthetic Twitch chat logs in the same JSON format that is read by import.py. The same seed and options
+	always produce the same chat logs, meaning they can be used to compare the performance of different versions of the scripts.
+"""
+
+import json
+import os
+import random
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Tuple
+
+# Common words and emotes in order of popularity. Their frequency follows Zipf's law, like in real chat.
+VOCABULARY: List[str] = [
+	'LUL', 'KEKW', 'the', 'Pog', 'lol', '?', 'a', 'monkaS', 'OMEGALUL', 'PogChamp', 'is', 'LMAO', '+2', 'xd', 'Kappa', 'I',
+	'it', 'D:', 'this', 'WTF', '-2', 'Sadge', 'PepeHands', 'you', 'that', 'ratJAM', 'catJAM', 'lmao', 'NOPERS', 'LOL', 'nice',
+	'4Head', 'no', 'bruh', 'Clap', 'so', 'monkaW', 'what', 'HUH', 'yes', 'POGGERS', 'gg', 'ResidentSleeper', 'Jebaited', 'o7',
+	'EZ', 'good', 'game', 'chat', 'widepeepoHappy', 'haHAA', 'BibleThump', 'ok', 'true', 'pepeLaugh', 'copium', 'KomodoHype',
+	'Wutface', 'peepoHappy', 'FeelsBadMan', 'FeelsGoodMan', 'bonk', 'Madge', 'forsenCD', 'PauseChamp', 'what?', 'LULW', '??',
+	'hello', 'hi', 'HeyGuys', 'wow', 'DansGame', 'NotLikeThis', 'SeemsGood', 'CoolStoryBob', 'BabyRage', 'SMOrc', 'VoHiYo',
+]
+
+# The emotes that dominate chat during a burst, e.g. everyone spamming LUL after a funny moment.
+BURST_EMOTES: List[str] = ['LUL', 'KEKW', 'Pog', 'monkaS', 'D:', '+2', '-2', 'Sadge', 'ratJAM', 'WTF', '?', 'bonk', 'LMAO']
+
+class ChatGenerator():
+	""" Generates the chat messages of a VOD as a non-homogeneous Poisson process, where the message rate increases during random bursts. """
+
+	rng: random.Random
+	duration: int
+	message_rate: float
+	bursts_per_hour: float
+	max_burst_multiplier: float
+
+	# Determined at runtime.
+	burst_list: List[Tuple[float, float, float, str]]
+	burst_index: int
+	vocabulary_weights: List[float]
+
+	def __init__(self, seed: int, duration: int, message_rate: float, bursts_per_hour: float = 12, max_burst_multiplier: float = 8, zipf_exponent: float = 1.1):
+
+		self.rng = random.Random(seed)
+		self.duration = duration
+		self.message_rate = message_rate
+		self.bursts_per_hour = bursts_per_hour
+		self.max_burst_multiplier = max_burst_multiplier
+
+		self.vocabulary_weights = [1 / (rank ** zipf_exponent) for rank in range(1, len(VOCABULARY) + 1)]
+
+		# Each burst has a start time, a length, a rate multiplier, and the emote that most of its messages contain.
+		self.burst_list = []
+		time = self.rng.expovariate(bursts_per_hour / 3600) if bursts_per_hour > 0 else duration
+		while time < duration:
+			length = self.rng.uniform(5, 40)
+			multiplier = self.rng.uniform(2, max_burst_multiplier)
+			emote = self.rng.choice(BURST_EMOTES)
+			self.burst_list.append((time, length, multiplier, emote))
+			time += length + self.rng.expovariate(bursts_per_hour / 3600)
+
+		self.burst_index = 0
+
+	def get_burst(self, time: float) -> Tuple[float, str]:
+		""" Returns the rate multiplier and emote of the burst at a given time, or a multiplier of one if there isn't one. Must be
+		called with increasing times. """
+
+		while self.burst_index < len(self.burst_list):
+
+			begin_time, length, multiplier, emote = self.burst_list[self.burst_index]
+			
+			if time < begin_time:
+				break
+			elif time < begin_time + length:
+				# The burst fades out linearly after its peak.
+				return 1 + (multiplier - 1) * (1 - (time - begin_time) / length), emote
+			
+			self.burst_index += 1
+
+		return 1, ''
+
+	def generate_message(self, burst_emote: str) -> str:
+
+		num_words = min(1 + int(self.rng.expovariate(0.6)), 12)
+		word_list = self.rng.choices(VOCABULARY, weights=self.vocabulary_weights, k=num_words)
+
+		# Burst messages repeat the same emote, sometimes several times.
+		if burst_emote and self.rng.random() < 0.75:
+			word_list = word_list[:self.rng.randint(0, 2)] + [burst_emote] * self.rng.randint(1, 3)
+
+		return ' '.join(word_list)
+
+	def generate(self) -> Iterator[Tuple[float, str]]:
+		""" Yields the offset in seconds and the text of every chat message in order. """
+
+		# Thinning: generate candidate messages at the maximum possible rate and keep each one with a probability proportional
+		# to the real rate at that time.
+		max_rate = self.message_rate * self.max_burst_multiplier
+		if max_rate <= 0:
+			return
+
+		time = 0.0
+		while True:
+			time += self.rng.expovariate(max_rate)
+			if time >= self.duration:
+				break
+
+			multiplier, burst_emote = self.get_burst(time)
+			if self.rng.random() * max_rate < self.message_rate * multiplier:
+				yield round(time, 3), self.generate_message(burst_emote)
+
+def generate_chat_log(seed: int, channel_name: str, video_id: str, creation_datetime: datetime, duration: int, message_rate: float, **kwargs) -> dict:
+	""" Generates a VOD's chat log with the same keys as the JSON files read by import.py. """
+
+	hours, remainder = divmod(duration, 3600)
+	minutes, seconds = divmod(remainder, 60)
+
+	generator = ChatGenerator(seed, duration, message_rate, **kwargs)
+
+	return {
+		'video': {
+			'user_name': channel_name,
+			'id': video_id,
+			'title': f'Synthetic VOD {video_id}',
+			'created_at': creation_datetime.strftime('%Y-%m-%dT%H:%M:%SZ'),
+			'duration': f'{hours}h{minutes}m{seconds}s',
+		},
+		'comments': [{'content_offset_seconds': offset, 'message': {'body': message}} for offset, message in generator.generate()],
+	}
+
+def generate_chat_logs(output_path: str, num_vods: int, seed: int, channel_name: str, begin_date: str, duration: int, message_rate: float, **kwargs) -> List[str]:
+	""" Generates one chat log per day starting at a given date, saves them to JSON files, and returns their paths. """
+
+	os.makedirs(output_path, exist_ok=True)
+
+	begin_datetime = datetime.strptime(begin_date, '%Y-%m-%d').replace(hour=18, tzinfo=timezone.utc)
+	file_path_list = []
+
+	for i in range(num_vods):
+
+		video_id = str(1_000_000 + i)
+		creation_datetime = begin_datetime + timedelta(days=i)
+		chat_log = generate_chat_log(seed + i, channel_name, video_id, creation_datetime, duration, message_rate, **kwargs)
+
+		file_path = os.path.join(output_path, f'{channel_name}_{video_id}.json')
+		with open(file_path, 'w', encoding='utf-8') as file:
+			json.dump(chat_log, file)
+
+		file_path_list.append(file_path)
+
+	return file_path_list
+
+if __name__ == '__main__':
+
+	parser = ArgumentParser(description='Generates synthetic Twitch chat logs that can be imported using import.py. The same options always generate the same chat logs.')
+	parser.add_argument('output_path', help='The directory where the JSON files are saved.')
+	parser.add_argument('-vods', type=int, default=4, help='How many chat logs to generate, one per day. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-seed', type=int, default=1, help='The random seed for the first chat log. Each of the following ones uses the next number. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-channel', default='benchmark', help='The channel name of every VOD. If omitted, this defaults to "%(default)s".')
+	parser.add_argument('-begin-date', default='2022-01-01', help='The creation date of the first VOD in the format YYYY-MM-DD. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-length', type=int, default=4 * 3600, help='The length of each VOD in seconds. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-rate', type=float, default=5, help='The average number of chat messages per second outside of bursts. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-bursts-per-hour', type=float, default=12, help='The average number of bursts of chat activity per hour. If omitted, this defaults to %(default)s.')
+	args = parser.parse_args()
+
+	file_path_list = generate_chat_logs(args.output_path, args.vods, args.seed, args.channel, args.begin_date, args.length, args.rate, bursts_per_hour=args.bursts_per_hour)
+
+	for file_path in file_path_list:
+		print(f'Saved the chat log to "{file_path}".')
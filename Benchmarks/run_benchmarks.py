@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+
+"""
+	Measures the performance of the scripts in the source directory using synthetic chat logs, and saves the results to a JSON file
+	so that different runs can be compared.
+"""
+
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import runpy
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from argparse import ArgumentParser
+from collections import namedtuple
+from datetime import datetime, timezone
+from math import ceil
+from typing import Callable, List
+
+import numpy as np
+
+from generate_chat import ChatGenerator, generate_chat_logs
+
+BENCHMARK_NAMES: List[str] = ['import', 'fetch', 'count', 'summary', 'highlight', 'api', 'bot', 'compact']
+
+SOURCE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'Source'))
+
+def create_config(database_path: str, channel_name: str, begin_date: str, num_days: int) -> dict:
+	""" Creates the configuration used by every script, with the same categories and comparisons as the template. """
+
+	with open(os.path.join(SOURCE_PATH, 'config.json.template'), encoding='utf-8') as file:
+		template = json.load(file)
+
+	highlight = template['highlight']
+	highlight.update({
+		'channel_name': channel_name,
+		'vod_criteria': 'date',
+		'begin_date': begin_date,
+		'num_days': num_days,
+		'get_vods_from_api': False,
+		'plot_categories': False,
+		'cache_frequency': False,
+	})
+
+	return {
+		'common': {'client_id': '', 'client_secret': None, 'access_token': '', 'database_path': database_path},
+		'bot': {'channels': [channel_name], 'max_write_retries': 5, 'write_retry_wait_time': 1},
+		'highlight': highlight,
+	}
+
+def time_best(function: Callable[[], None], repeat: int) -> float:
+	""" Returns the fastest of several runs of a function in seconds. """
+
+	best_time = float('inf')
+	for _ in range(repeat):
+		start_time = time.perf_counter()
+		function()
+		best_time = min(best_time, time.perf_counter() - start_time)
+
+	return best_time
+
+def run_script(script_name: str, argument_list: List[str], working_path: str) -> float:
+	""" Runs a script in the source directory as a separate process and returns how long it took in seconds. """
+
+	start_time = time.perf_counter()
+	subprocess.run([sys.executable, os.path.join(SOURCE_PATH, script_name)] + argument_list, cwd=working_path, check=True, stdout=subprocess.DEVNULL)
+	return time.perf_counter() - start_time
+
+def connect_to_database(database_path: str) -> sqlite3.Connection:
+	""" Opens the benchmark database without migrating it. highlight.py reads the chat through the temporary AllChat view, which is
+	normally created when connecting via the common config, so it's created here too. """
+
+	from common import attach_chat_shards
+
+	db = sqlite3.connect(database_path, isolation_level=None)
+	db.row_factory = sqlite3.Row
+	attach_chat_shards(db, None, [])
+	return db
+
+def load_highlight_module() -> types.ModuleType:
+	""" Imports highlight.py without running it, which gives access to its counting and summary functions. """
+
+	spec = importlib.util.spec_from_file_location('highlight', os.path.join(SOURCE_PATH, 'highlight.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module) # type: ignore
+	return module
+
+def run_bot(num_messages: int, channel_name: str, seed: int, message_rate: float) -> float:
+	""" Runs bot.py with a fake Twitch connection that sends it a given number of synthetic chat messages as fast as possible, and returns
+	how long it took to read and save all of them in seconds. """
+
+	message_list = []
+	unix_time = datetime(2022, 1, 1, 18, tzinfo=timezone.utc).timestamp()
+	generator = ChatGenerator(seed, duration=10**9, message_rate=message_rate)
+
+	for offset, text in generator.generate():
+
+		if len(message_list) >= num_messages:
+			break
+
+		# Only the attributes that are used by ChatTranscriptBot.event_message.
+		sent_timestamp = round((unix_time + offset) * 1000)
+		message = types.SimpleNamespace(echo=False, content=text, channel=types.SimpleNamespace(name=channel_name), tags={'tmi-sent-ts': str(sent_timestamp)},
+										timestamp=datetime.fromtimestamp(sent_timestamp / 1000, tz=timezone.utc).replace(tzinfo=None))
+		message_list.append(message)
+
+	elapsed_time = 0.0
+
+	class BenchmarkBot():
+		""" Replaces twitchio's commands.Bot so that the chat messages are sent by the benchmark instead of Twitch. """
+
+		nick = 'benchmark'
+
+		def __init__(self, **kwargs):
+			pass
+
+		def run(self):
+
+			async def send_messages():
+				for message in message_list:
+					await self.event_message(message)
+				await self.close()
+
+			nonlocal elapsed_time
+			start_time = time.perf_counter()
+			asyncio.run(send_messages())
+			elapsed_time = time.perf_counter() - start_time
+
+	twitchio_module = types.ModuleType('twitchio')
+	twitchio_ext_module = types.ModuleType('twitchio.ext')
+	commands_module = types.ModuleType('twitchio.ext.commands')
+	commands_module.Bot = BenchmarkBot # type: ignore
+	twitchio_ext_module.commands = commands_module # type: ignore
+	twitchio_module.ext = twitchio_ext_module # type: ignore
+
+	previous_modules = {name: sys.modules.get(name) for name in ['twitchio', 'twitchio.ext', 'twitchio.ext.commands']}
+	previous_argv = sys.argv
+
+	try:
+		sys.modules.update({'twitchio': twitchio_module, 'twitchio.ext': twitchio_ext_module, 'twitchio.ext.commands': commands_module})
+		sys.argv = [os.path.join(SOURCE_PATH, 'bot.py')]
+		runpy.run_path(sys.argv[0], run_name='__main__')
+	finally:
+		sys.argv = previous_argv
+		for name, module in previous_modules.items():
+			if module is None:
+				sys.modules.pop(name, None)
+			else:
+				sys.modules[name] = module
+
+	return elapsed_time
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> bool:
+	""" Prints how much faster or slower each benchmark was compared to a previous run. Returns false if any of them regressed. """
+
+	passed = True
+
+	print()
+	print(f'{"Benchmark":<12} {"Baseline":>12} {"Current":>12} {"Speedup":>9}')
+
+	for name, result in results['benchmarks'].items():
+
+		baseline_result = baseline.get('benchmarks', {}).get(name)
+		if baseline_result is None:
+			continue
+
+		speedup = baseline_result['seconds'] / result['seconds'] if result['seconds'] > 0 else float('inf')
+		is_regression = result['seconds'] > baseline_result['seconds'] * (1 + tolerance)
+		passed = passed and not is_regression
+
+		print(f'{name:<12} {baseline_result["seconds"]:>11.3f}s {result["seconds"]:>11.3f}s {speedup:>8.2f}x' + (' (regression)' if is_regression else ''))
+
+	if baseline.get('parameters') != results['parameters']:
+		print('Warning: the baseline was run with different parameters.')
+
+	return passed
+
+if __name__ == '__main__':
+
+	parser = ArgumentParser(description='Measures the performance of the scripts in the source directory using synthetic chat logs, and saves the results to a JSON file. Every run with the same options uses the same chat messages.')
+	parser.add_argument('-output', default='benchmark_results.json', help='Where to save the results. If omitted, this defaults to "%(default)s".')
+	parser.add_argument('-baseline', help='The results of a previous run to compare against. The script fails if any benchmark is slower than the baseline by more than the tolerance.')
+	parser.add_argument('-tolerance', type=float, default=0.1, help='How much slower than the baseline each benchmark may be, as a fraction. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-benchmarks', nargs='+', choices=BENCHMARK_NAMES, default=BENCHMARK_NAMES, help='Which benchmarks to run. If omitted, all of them are run.')
+	parser.add_argument('-vods', type=int, default=4, help='How many chat logs to generate, one per day. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-length', type=int, default=4 * 3600, help='The length of each VOD in seconds. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-rate', type=float, default=5, help='The average number of chat messages per second outside of bursts. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-seed', type=int, default=1, help='The random seed used to generate the chat messages. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-bot-messages', type=int, default=100_000, help='How many chat messages to send to the bot. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-repeat', type=int, default=3, help='How many times to repeat the benchmarks that only read from the database. The fastest run is used. If omitted, this defaults to %(default)s.')
+	args = parser.parse_args()
+
+	# The benchmarks that read from the database or run highlight.py require the chat logs to be imported first.
+	benchmark_names = [name for name in BENCHMARK_NAMES if name in args.benchmarks]
+	needs_import = any(name != 'bot' for name in benchmark_names)
+
+	channel_name = 'benchmark'
+	begin_date = '2022-01-01'
+
+	results: dict = {
+		'time': datetime.now(tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+		'python': platform.python_version(),
+		'sqlite': sqlite3.sqlite_version,
+		'platform': platform.platform(),
+		'parameters': {'vods': args.vods, 'length': args.length, 'rate': args.rate, 'seed': args.seed, 'bot_messages': args.bot_messages},
+		'benchmarks': {},
+	}
+
+	sys.path.insert(0, SOURCE_PATH)
+
+	with tempfile.TemporaryDirectory(prefix='chat_benchmark_') as working_path:
+
+		database_path = os.path.join(working_path, 'chat.db')
+		config = create_config(database_path, channel_name, begin_date, args.vods)
+
+		with open(os.path.join(working_path, 'config.json'), 'w', encoding='utf-8') as file:
+			json.dump(config, file, indent='\t')
+
+		previous_path = os.getcwd()
+		os.chdir(working_path)
+
+		try:
+			num_messages = 0
+			video_listing = []
+
+			if needs_import:
+
+				print(f'Generating {args.vods} chat logs...')
+				file_path_list = generate_chat_logs(os.path.join(working_path, 'logs'), args.vods, args.seed, channel_name, begin_date, args.length, args.rate)
+
+				for file_path in file_path_list:
+					with open(file_path, encoding='utf-8') as file:
+						chat_log = json.load(file)
+					
+					num_messages += len(chat_log['comments'])
+
+					# The same fields as the Twitch API, so that highlight.py can find the VODs without network access.
+					video = chat_log['video']
+					video_listing.append({'id': video['id'], 'user_login': channel_name, 'title': video['title'], 'created_at': video['created_at'], 'duration': video['duration'], 'type': 'archive'})
+					del chat_log
+
+				print(f'Importing {num_messages} chat messages...')
+				elapsed_time = run_script('import.py', [os.path.join(working_path, 'logs', '*.json')], working_path)
+				results['benchmarks']['import'] = {'seconds': elapsed_time, 'messages': num_messages, 'messages_per_second': num_messages / elapsed_time}
+
+			if needs_import and any(name in benchmark_names for name in ['fetch', 'count', 'summary']):
+
+				highlight = load_highlight_module()
+				highlight_config = config['highlight']
+				bucket_length = highlight_config['bucket_length']
+
+				category_list = [highlight.Category(**category_params) for category_params in highlight_config['categories']]
+				for i, category in enumerate(category_list):
+					category.frequency_index = i
+
+				db = connect_to_database(database_path)
+				Video = namedtuple('Video', ['Id', 'Duration'])
+				video_list = [Video(*row) for row in db.execute('SELECT Id, Duration FROM Video ORDER BY CreationTime;')]
+
+				def fetch_chat() -> None:
+					# The same query as the one used by highlight.py to read each VOD's chat.
+					for video in video_list:
+						db.execute('''
+									SELECT
+										CT.Message,
+										CT.UnixTimestamp,
+										COALESCE(CT.VideoOffset, CT.UnixTimestamp - V.UnixCreationTime) / 1000000 AS Offset
+									FROM AllChat CT
+									INNER JOIN Video V ON CT.VideoId = V.Id
+									INNER JOIN Channel CL ON V.ChannelId = CL.Id
+									WHERE V.Id = :video_id
+									ORDER BY CT.Timestamp;
+									''', {'video_id': video.Id}).fetchall()
+
+				frequency_list: list = []
+
+				def count_chat() -> None:
+					frequency_list.clear()
+					matcher = highlight.CategoryMatcher(category_list)
+					for video in video_list:
+						_, _, _, duration_in_seconds = highlight.split_twitch_duration(video.Duration)
+						num_buckets = ceil(duration_in_seconds / bucket_length)
+						frequency_list.append(highlight.count_category_frequency(db, lambda _: matcher, category_list, video.Id, num_buckets, bucket_length, None, False))
+
+				Candidate = namedtuple('Candidate', ['Video', 'Bucket', 'Count'])
+
+				# Every bucket with at least one message is a candidate, which is the worst case for the top highlight selection.
+				def summarize_chat() -> None:
+					for category in category_list:
+						candidate_list = []
+						for video, frequency in zip(video_list, frequency_list):
+							bucket_list = np.flatnonzero(frequency[category.frequency_index] >= 1).tolist()
+							candidate_list.extend(Candidate(video, i, count) for i, count in zip(bucket_list, frequency[category.frequency_index][bucket_list].tolist()))
+						highlight.select_top_candidates(candidate_list, lambda x: x.Count, True, max(category.top, 10), highlight_config['top_bucket_distance_threshold'])
+
+				if 'fetch' in benchmark_names:
+					print('Fetching the chat of every VOD...')
+					elapsed_time = time_best(fetch_chat, args.repeat)
+					results['benchmarks']['fetch'] = {'seconds': elapsed_time, 'messages': num_messages, 'messages_per_second': num_messages / elapsed_time}
+
+					# The same queries on the original schema (version 0), before the first migration added the Chat indexes. The indexes
+					# are only dropped inside a transaction that is rolled back, so the database is left unchanged.
+					print('Fetching the chat of every VOD without the Chat indexes...')
+					db.execute('BEGIN;')
+					for index_name in ['ChatVideoIndex', 'ChatChannelIndex']:
+						db.execute(f'DROP INDEX {index_name};')
+					
+					elapsed_time = time_best(fetch_chat, args.repeat)
+					db.execute('ROLLBACK;')
+					results['benchmarks']['fetch_v0'] = {'seconds': elapsed_time, 'messages': num_messages, 'messages_per_second': num_messages / elapsed_time}
+
+				if 'count' in benchmark_names or 'summary' in benchmark_names:
+					print('Counting the messages in each category...')
+					elapsed_time = time_best(count_chat, args.repeat)
+					if 'count' in benchmark_names:
+						results['benchmarks']['count'] = {'seconds': elapsed_time, 'messages': num_messages, 'messages_per_second': num_messages / elapsed_time}
+
+				if 'summary' in benchmark_names:
+					print('Selecting the top highlights...')
+					elapsed_time = time_best(summarize_chat, args.repeat)
+					results['benchmarks']['summary'] = {'seconds': elapsed_time, 'categories': len(category_list)}
+
+				db.close()
+
+			if 'highlight' in benchmark_names:
+				print('Running highlight.py...')
+				elapsed_time = run_script('highlight.py', [], working_path)
+				results['benchmarks']['highlight'] = {'seconds': elapsed_time, 'messages': num_messages, 'messages_per_second': num_messages / elapsed_time}
+
+			if 'api' in benchmark_names:
+
+				listing_path = os.path.join(working_path, 'videos.json')
+				with open(listing_path, 'w', encoding='utf-8') as file:
+					json.dump(video_listing, file)
+
+				api_config = json.loads(json.dumps(config))
+				api_config['highlight'].update({'get_vods_from_api': True, 'vod_listing_path': listing_path})
+
+				with open(os.path.join(working_path, 'config.json'), 'w', encoding='utf-8') as file:
+					json.dump(api_config, file, indent='\t')
+
+				# The first run lists every VOD and checks which chat messages belong to them, while the second one only lists
+				# the newest VOD again.
+				print('Running highlight.py with the VODs listed from a local file...')
+				first_elapsed_time = run_script('highlight.py', [], working_path)
+				elapsed_time = run_script('highlight.py', [], working_path)
+				results['benchmarks']['api'] = {'seconds': elapsed_time, 'first_seconds': first_elapsed_time, 'messages': num_messages, 'messages_per_second': num_messages / elapsed_time}
+
+				with open(os.path.join(working_path, 'config.json'), 'w', encoding='utf-8') as file:
+					json.dump(config, file, indent='\t')
+
+			if 'bot' in benchmark_names:
+				print(f'Sending {args.bot_messages} chat messages to bot.py...')
+				elapsed_time = run_bot(args.bot_messages, channel_name, args.seed, args.rate)
+				results['benchmarks']['bot'] = {'seconds': elapsed_time, 'messages': args.bot_messages, 'messages_per_second': args.bot_messages / elapsed_time}
+
+			# This runs last since it removes the messages from the Chat table. The result is the time it takes to read every compacted
+			# VOD, which can be compared with the fetch benchmark.
+			if 'compact' in benchmark_names:
+				
+				print('Running compact.py...')
+				compact_elapsed_time = run_script('compact.py', [], working_path)
+
+				highlight = load_highlight_module()
+				db = connect_to_database(database_path)
+				video_id_list = [row[0] for row in db.execute('SELECT VideoId FROM CompactedChat;')]
+
+				def fetch_compacted_chat() -> None:
+					for video_id in video_id_list:
+						highlight.read_compacted_chat(db, video_id)
+
+				print('Fetching the compacted chat of every VOD...')
+				elapsed_time = time_best(fetch_compacted_chat, args.repeat)
+				raw_size, compressed_size = db.execute('SELECT SUM(RawSize), SUM(LENGTH(Data)) FROM CompactedChat;').fetchone()
+				db.close()
+				
+				results['benchmarks']['compact'] = {'seconds': elapsed_time, 'compact_seconds': compact_elapsed_time, 'messages': num_messages, 'messages_per_second': num_messages / elapsed_time,
+													'raw_bytes': raw_size, 'compressed_bytes': compressed_size}
+
+		finally:
+			os.chdir(previous_path)
+
+	with open(args.output, 'w', encoding='utf-8') as file:
+		json.dump(results, file, indent='\t')
+
+	print()
+	print(f'{"Benchmark":<12} {"Seconds":>10} {"Messages/s":>12}')
+	for name, result in results['benchmarks'].items():
+		messages_per_second = f'{result["messages_per_second"]:>12.0f}' if 'messages_per_second' in result else f'{"-":>12}'
+		print(f'{name:<12} {result["seconds"]:>10.3f} {messages_per_second}')
+
+	print()
+	print(f'Saved the results to "{args.output}".')
+
+	if args.baseline is not None:
+
+		with open(args.baseline, encoding='utf-8') as file:
+			baseline = json.load(file)
+
+		if not compare_results(results, baseline, args.tolerance):
+			sys.exit(1)
@@ -2,14 +2,18 @@
 
 import asyncio
 import logging
+import queue
 import sqlite3
+import threading
+import time
 from argparse import ArgumentParser
+from collections import Counter
 from datetime import datetime, timezone
-from typing import List
+from typing import Dict, List, Optional
 
 from twitchio.ext import commands # type: ignore
 
-from common import CommonConfig
+from common import CommonConfig, Category, CategoryMatcher, DatabaseIdCache, WordVocabulary, attach_chat_shards, convert_datetime_to_unix_time, encode_word_ids, get_chat_shard_name, format_unix_time
 
 class BotConfig(CommonConfig):
 
@@ -17,12 +21,34 @@ class BotConfig(CommonConfig):
 	channels: List[str]
 	max_write_retries: int
 	write_retry_wait_time: int
+	write_batch_size: int
+	write_batch_interval: float
+	max_queued_messages: int
+	detect_highlights: bool
+
+	# From the highlight section of the config file when detect_highlights is enabled.
+	highlight_categories: List[Category]
+	highlight_window_length: int
+	highlight_message_threshold: int
 
 	def __init__(self):
 		
 		super().__init__()
+
+		self.write_batch_size = 500
+		self.write_batch_interval = 1
+		self.max_queued_messages = 100_000
+		self.detect_highlights = False
+
 		self.__dict__.update(self.json_config['bot'])
 
+		self.highlight_categories = []
+		if self.detect_highlights:
+			highlight_config = self.json_config['highlight']
+			self.highlight_categories = [Category(**category_params) for category_params in highlight_config['categories']]
+			self.highlight_window_length = highlight_config['bucket_length']
+			self.highlight_message_threshold = highlight_config['message_threshold']
+
 if __name__ == '__main__':
 
 	parser = ArgumentParser(description='Runs a bot that joins a given number of Twitch channels and saves any public chat messages sent during a live stream to the database. Be sure to get a streamer\'s permission before running this bot on their channel.')
@@ -44,26 +70,203 @@ if __name__ == '__main__':
 	log.addHandler(log_file_handler)
 	log.addHandler(log_stream_handler)
 
-	class ChatTranscriptBot(commands.Bot):
+	class ChatWriter(threading.Thread):
+		""" Writes the chat messages received by the bot to the database in batches so that the event loop never waits for SQLite. """
 
-		def __init__(self):
-			super().__init__(token=config.access_token, prefix='!', client_secret=config.client_secret, initial_channels=config.channels)
+		def __init__(self, message_tally: dict):
+			super().__init__(name='ChatWriter', daemon=True)
+			self.queue: queue.Queue = queue.Queue(maxsize=config.max_queued_messages)
+			self.message_tally = message_tally
+			self.db = None
+			self.id_cache = None
+			self.vocabulary = None
+			self.shard_names = []
+
+		def run(self):
 
+			# SQLite connections can only be used by the thread that created them.
 			try:
 				self.db = config.connect_to_database()
 				log.info(f'Connected to the database: {config.database_path}')
 			except sqlite3.Error as error:
 				log.error(f'Failed to connect to the database with the error: {repr(error)}')
 
-			self.message_tally = {}
-
 			try:
+				self.id_cache = DatabaseIdCache(self.db)
+				self.vocabulary = WordVocabulary(self.db)
 				for channel_name in config.channels:
-					self.db.execute('INSERT OR IGNORE INTO Channel (Name) VALUES (:name);', {'name': channel_name.lower()})
-					self.message_tally[channel_name] = {'success': 0, 'failure': 0, 'total': 0}
-			except sqlite3.Error as error:
+					self.id_cache.get_channel_id(channel_name, insert=True)
+			except (sqlite3.Error, AttributeError) as error:
 				log.error(f'Failed to insert the channel names with the error: {repr(error)}')
 
+			finished = False
+			while not finished:
+
+				# Wait for the first message, then keep collecting them until the batch is full or its time is up.
+				# A None item means that the bot is closing and that every remaining message should be written.
+				batch = []
+				item = self.queue.get()
+				deadline = time.monotonic() + config.write_batch_interval
+
+				while item is not None:
+
+					batch.append(item)
+
+					remaining_time = deadline - time.monotonic()
+					if len(batch) >= config.write_batch_size or remaining_time <= 0:
+						break
+
+					try:
+						item = self.queue.get(timeout=remaining_time)
+					except queue.Empty:
+						break
+
+				if item is None:
+					finished = True
+
+				# The writer must keep running no matter what, otherwise the queue would fill up and the bot would never close.
+				if batch:
+					try:
+						self.write_batch(batch)
+					except Exception as error:
+						log.error(f'Failed to write a batch of {len(batch)} items with the unexpected error: {repr(error)}')
+
+			try:
+				if self.db is not None:
+					self.db.close()
+			except sqlite3.Error as error:
+				log.warning(f'Failed to close the database with the error: {repr(error)}')
+
+		def write_batch(self, batch: List[dict]):
+
+			# The queue contains both chat messages and any highlights that were detected while reading them.
+			message_list = [item for item in batch if 'message' in item]
+			highlight_list = [item for item in batch if 'category_name' in item]
+
+			# If the chat is sharded, each message is saved to the shard of the month when it was sent.
+			shard_messages: Dict[str, List[dict]] = {}
+			for item in message_list:
+				schema = get_chat_shard_name(item['unix_timestamp']) if config.chat_shard_path is not None else 'main'
+				shard_messages.setdefault(schema, []).append(item)
+
+			# Each batch is written in a single transaction. If it keeps failing, every message in it is counted as a failure.
+			for i in range(config.max_write_retries):
+
+				try:
+					for item in batch:
+						item['channel_id'] = self.id_cache.get_channel_id(item['channel_name'])
+
+					# The previous shards stay attached until the messages are saved to a different one (e.g. when a new month begins).
+					shard_names = sorted(schema for schema in shard_messages if schema != 'main')
+					if not set(shard_names) <= set(self.shard_names):
+						attach_chat_shards(self.db, config.chat_shard_path, shard_names, create=True)
+						self.shard_names = shard_names
+
+					self.db.execute('BEGIN;')
+
+					# Any new words are inserted in the same transaction as the messages that use them.
+					for item in message_list:
+						item['word_ids'] = encode_word_ids(self.vocabulary.get_word_ids(item['message'].lower().split())) if config.tokenize_messages else None
+
+					for schema, schema_message_list in shard_messages.items():
+						self.db.executemany(f'INSERT INTO {schema}.Chat (ChannelId, Timestamp, UnixTimestamp, Message, WordIds) VALUES (:channel_id, :timestamp, :unix_timestamp, :message, :word_ids);', schema_message_list)
+					
+					if highlight_list:
+						self.db.executemany('''
+											INSERT INTO LiveHighlight (ChannelId, Timestamp, UnixTimestamp, CategoryName, NumMessages, WindowLength)
+											VALUES (:channel_id, :timestamp, :unix_timestamp, :category_name, :num_messages, :window_length);
+											''', highlight_list)
+					
+					self.db.execute('COMMIT;')
+				except (sqlite3.Error, OSError, AttributeError) as error:
+					if self.db is not None and self.db.in_transaction:
+						self.db.execute('ROLLBACK;')
+					if self.vocabulary is not None:
+						self.vocabulary.forget_all()
+					log.warning(f'Attempting to reinsert {len(batch)} messages that failed with the error: {repr(error)}')
+					time.sleep(config.write_retry_wait_time)
+				else:
+					result = 'success'
+					break
+			else:
+				for item in message_list:
+					channel_name, timestamp, message = item['channel_name'], item['timestamp'], item['message']
+					log.error(f'Failed to insert the message ({channel_name}, {timestamp}, "{message}")')
+				for item in highlight_list:
+					channel_name, timestamp, category_name = item['channel_name'], item['timestamp'], item['category_name']
+					log.error(f'Failed to insert the highlight ({channel_name}, {timestamp}, "{category_name}")')
+				result = 'failure'
+
+			for channel_name, count in Counter(item['channel_name'] for item in message_list).items():
+				self.message_tally[channel_name][result] += count
+				self.message_tally[channel_name]['total'] += count
+
+	class RollingCategoryCounter():
+		""" Counts the messages in each highlight category that were sent during the last few seconds of a channel's chat. These are
+		kept in one slot per second so that the memory used by each channel doesn't depend on how many messages it receives. """
+
+		def __init__(self, num_categories: int, window_length: int, message_threshold: int):
+			self.window_length = window_length
+			self.message_threshold = message_threshold
+			self.slot_counts = [[0] * num_categories for _ in range(window_length)]
+			self.totals = [0] * num_categories
+			self.active = [False] * num_categories
+			self.latest_second: Optional[int] = None
+
+		def add(self, second: int, category_indexes: List[int]) -> List[int]:
+			""" Counts a message sent at a given second (since the Unix epoch) and returns the indexes of the categories that reached
+			the message threshold because of it. A category has to drop below the threshold before it can be returned again. """
+
+			if self.latest_second is None or second > self.latest_second:
+				
+				# Clear any slots that fell out of the window, which is every slot if there was a long pause in chat.
+				if self.latest_second is not None:
+					for expired_second in range(max(self.latest_second + 1, second - self.window_length + 1), second + 1):
+						slot = self.slot_counts[expired_second % self.window_length]
+						for i, count in enumerate(slot):
+							self.totals[i] -= count
+							slot[i] = 0
+
+				self.latest_second = second
+
+			elif second <= self.latest_second - self.window_length:
+				# Too old to be inside the window.
+				return []
+
+			slot = self.slot_counts[second % self.window_length]
+			for i in category_indexes:
+				slot[i] += 1
+				self.totals[i] += 1
+
+			crossed_indexes = []
+			for i, total in enumerate(self.totals):
+				if total >= self.message_threshold:
+					if not self.active[i]:
+						self.active[i] = True
+						crossed_indexes.append(i)
+				else:
+					self.active[i] = False
+
+			return crossed_indexes
+
+	class ChatTranscriptBot(commands.Bot):
+
+		def __init__(self):
+			super().__init__(token=config.access_token, prefix='!', client_secret=config.client_secret, initial_channels=config.channels)
+
+			self.message_tally = {}
+			for channel_name in config.channels:
+				self.message_tally[channel_name.lower()] = {'success': 0, 'failure': 0, 'total': 0}
+
+			self.writer = ChatWriter(self.message_tally)
+			self.writer.start()
+			self.queue_lock = asyncio.Lock()
+			self.is_queue_full = False
+
+			# Highlights are detected using only the messages in memory so that reading chat never waits for the database.
+			self.matcher = CategoryMatcher(config.highlight_categories) if config.detect_highlights else None
+			self.highlight_counters: Dict[str, RollingCategoryCounter] = {}
+
 		async def event_ready(self):
 			log.info(f'Logged in as "{self.nick}" to the channels: ' + str(config.channels))
 
@@ -78,33 +281,62 @@ if __name__ == '__main__':
 			if message.echo:
 				return
 			
-			timestamp = message.timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')
+			# Use the raw IRC tag (milliseconds since the Unix epoch) when available since it avoids any datetime conversions.
+			sent_timestamp = message.tags.get('tmi-sent-ts') if message.tags else None
+			unix_timestamp = int(sent_timestamp) * 1000 if sent_timestamp else convert_datetime_to_unix_time(message.timestamp)
+			timestamp = format_unix_time(unix_timestamp)
 			channel_name = message.channel.name.lower()
 
-			for i in range(config.max_write_retries):
+			item_list = [{'channel_name': channel_name, 'timestamp': timestamp, 'unix_timestamp': unix_timestamp, 'message': message.content}]
+
+			if self.matcher is not None:
+				item_list.extend(self.count_highlight_message(channel_name, timestamp, unix_timestamp, message.content))
+
+			# Each message is handled in its own task, so the messages are queued while holding a lock that is acquired in the same order
+			# as they arrived. When the queue is full, this waits for the writer to catch up while any later messages wait for the lock,
+			# meaning that no messages are lost or reordered.
+			async with self.queue_lock:
+				for item in item_list:
+					try:
+						self.writer.queue.put_nowait(item)
+						# Only warn again after the writer has caught up with most of the queue.
+						if self.is_queue_full and self.writer.queue.qsize() <= config.max_queued_messages // 2:
+							self.is_queue_full = False
+					except queue.Full:
+						
+						if not self.is_queue_full:
+							log.warning(f'The write queue is full with {config.max_queued_messages} messages. Waiting for the database writer to catch up.')
+							self.is_queue_full = True
+
+						await asyncio.get_running_loop().run_in_executor(None, self.writer.queue.put, item)
+
+		def count_highlight_message(self, channel_name: str, timestamp: str, unix_timestamp: int, message: str) -> List[dict]:
+			""" Adds a chat message to its channel's rolling counts and returns any highlights that it triggered. """
+
+			counter = self.highlight_counters.get(channel_name)
+			if counter is None:
+				counter = RollingCategoryCounter(len(config.highlight_categories), config.highlight_window_length, config.highlight_message_threshold)
+				self.highlight_counters[channel_name] = counter
+
+			highlight_list = []
+			for i in counter.add(unix_timestamp // 1_000_000, self.matcher.match_message_indexes(message)):
 				
-				try:
-					self.db.execute('''
-									INSERT INTO Chat (ChannelId, Timestamp, Message)
-									VALUES ((SELECT CL.Id FROM Channel CL WHERE CL.Name = :channel_name), :timestamp, :message);
-									''', {'channel_name': channel_name, 'timestamp': timestamp, 'message': message.content})
-				except sqlite3.Error as error:
-					log.warning(f'Attempting to reinsert the message ({channel_name}, {timestamp}, "{message.content}") that failed with the error: {repr(error)}')
-					await asyncio.sleep(config.write_retry_wait_time)
-				else:
-					self.message_tally[channel_name]['success'] += 1
-					break
-			else:
-				log.error(f'Failed to insert the message ({channel_name}, {timestamp}, "{message.content}")')
-				self.message_tally[channel_name]['failure'] += 1
+				category = config.highlight_categories[i]
+				num_messages = counter.totals[i]
+				log.info(f'Detected a highlight in the "{channel_name}" channel at {timestamp} with {num_messages} messages in the "{category.name}" category over the last {config.highlight_window_length} seconds.')
+
+				highlight_list.append({'channel_name': channel_name, 'timestamp': timestamp, 'unix_timestamp': unix_timestamp, 'category_name': category.name,
+									   'num_messages': num_messages, 'window_length': config.highlight_window_length})
 
-			self.message_tally[channel_name]['total'] += 1
+			return highlight_list
 
 		async def close(self):
-			try:
-				self.db.close()
-			except sqlite3.Error as error:
-				log.warning(f'Failed to close the database with the error: {repr(error)}')
+
+			# Write any remaining messages before logging off. The lock makes sure that any messages that are still waiting are queued first.
+			loop = asyncio.get_running_loop()
+			async with self.queue_lock:
+				await loop.run_in_executor(None, self.writer.queue.put, None)
+			await loop.run_in_executor(None, self.writer.join)
 
 			log.info(f'Logged off "{self.nick}" from the channels with the following results: {self.message_tally}')
 
@@ -5,11 +5,23 @@
 	connecting to the database, and handling Twitch's timestamp formats.
 """
 
+import hashlib
 import json
+import lzma
 import os
+import re
 import sqlite3
-from datetime import datetime
-from typing import Optional, Tuple, Union
+import struct
+import sys
+import time
+import zlib
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import accumulate
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Pattern, TextIO, Tuple, Union
 
 ####################################################################################################
 
@@ -22,15 +34,24 @@ class CommonConfig():
 	client_secret: Optional[str]
 	access_token: str
 	database_path: str
+	chat_search_index: bool
+	tokenize_messages: bool
+	chat_shard_path: Optional[str]
 
 	def __init__(self):
 		
 		with open('config.json', encoding='utf-8') as file:
 			self.json_config = json.load(file)
 		
+		self.chat_search_index = False
+		self.tokenize_messages = False
+		self.chat_shard_path = None
 		self.__dict__.update(self.json_config['common'])
 
 		self.database_path = os.path.abspath(self.database_path)
+		
+		if self.chat_shard_path is not None:
+			self.chat_shard_path = os.path.abspath(self.chat_shard_path)
 
 	def connect_to_database(self) -> sqlite3.Connection:
 
@@ -82,10 +103,971 @@ class CommonConfig():
 						);
 						''')
 
+		migrate_database(db)
+
+		if self.chat_search_index:
+			create_chat_search_index(db)
+		else:
+			drop_chat_search_index(db)
+
+		# The AllChat view only reads the main database's messages until any chat shards are attached.
+		attach_chat_shards(db, self.chat_shard_path, [])
+
 		return db
 
 ####################################################################################################
 
+# Each entry upgrades the database schema by one version, where the current version is stored in the user_version pragma.
+# The tables above are always created first, meaning version 0 is the original schema. New entries must only be appended
+# to the end of this list.
+DATABASE_MIGRATIONS: List[str] = [
+
+	# Version 1: indexes for the per-VOD queries in highlight.py and for the per-channel time range updates that assign
+	# each chat message to a VOD. These let SQLite seek to a VOD or channel and read its messages in timestamp order
+	# instead of scanning and sorting the whole table.
+	'''
+	CREATE INDEX IF NOT EXISTS ChatVideoIndex ON Chat (VideoId, Timestamp);
+	CREATE INDEX IF NOT EXISTS ChatChannelIndex ON Chat (ChannelId, Timestamp);
+	PRAGMA analysis_limit = 1000;
+	ANALYZE;
+	''',
+
+	# Version 2: integer timestamps in microseconds since the Unix epoch (UTC), and the offset in microseconds relative to
+	# the beginning of the VOD when it's known. The original text columns are still written so that older scripts and
+	# third-party tools can read them.
+	'''
+	ALTER TABLE Video ADD COLUMN UnixCreationTime INTEGER;
+	ALTER TABLE Chat ADD COLUMN UnixTimestamp INTEGER;
+	ALTER TABLE Chat ADD COLUMN VideoOffset INTEGER;
+
+	UPDATE Video SET UnixCreationTime = CAST(strftime('%s', CreationTime) AS INTEGER) * 1000000 + CAST(substr(substr(CreationTime, 21) || '000000', 1, 6) AS INTEGER);
+	UPDATE Chat SET UnixTimestamp = CAST(strftime('%s', Timestamp) AS INTEGER) * 1000000 + CAST(substr(substr(Timestamp, 21) || '000000', 1, 6) AS INTEGER);
+	UPDATE Chat SET VideoOffset = UnixTimestamp - (SELECT V.UnixCreationTime FROM Video V WHERE V.Id = Chat.VideoId) WHERE VideoId IS NOT NULL;
+	''',
+
+	# Version 3: indexes that were temporarily dropped during a bulk load. These are recreated the next time import.py
+	# runs if the bulk load was interrupted.
+	'''
+	CREATE TABLE IF NOT EXISTS DeferredIndex
+	(
+	Name TEXT NOT NULL PRIMARY KEY,
+	Sql TEXT NOT NULL
+	);
+	''',
+
+	# Version 4: the chat log files that were imported by import.py, used to skip any unchanged files in future runs.
+	# The modification time is in nanoseconds and the hash is the file's SHA-256 digest.
+	'''
+	CREATE TABLE IF NOT EXISTS ImportedFile
+	(
+	Path TEXT NOT NULL PRIMARY KEY,
+	Size INTEGER NOT NULL,
+	ModificationTime INTEGER NOT NULL,
+	Hash VARCHAR(64) NOT NULL,
+	VideoTwitchId VARCHAR(50) NOT NULL,
+	NumMessages INTEGER NOT NULL,
+	ImportTime TIMESTAMP NOT NULL
+	);
+	''',
+
+	# Version 5: the number of messages per bucket that were counted by highlight.py for each VOD and category. Each entry
+	# is identified by the bucket length and a hash of the category's words, and is only valid while the VOD's chat has the
+	# same number of messages and the same maximum message ID. The counts are stored as little-endian 64-bit integers.
+	'''
+	CREATE TABLE IF NOT EXISTS FrequencyCache
+	(
+	VideoId INTEGER NOT NULL,
+	BucketLength INTEGER NOT NULL,
+	WordsHash VARCHAR(64) NOT NULL,
+	NumBuckets INTEGER NOT NULL,
+	ChatCount INTEGER NOT NULL,
+	ChatMaxId INTEGER NOT NULL,
+	Counts BLOB NOT NULL,
+
+	PRIMARY KEY (VideoId, BucketLength, WordsHash),
+	FOREIGN KEY (VideoId) REFERENCES Video (Id)
+	);
+	''',
+
+	# Version 6: the highlights detected by bot.py while a live stream is running. Each one is the moment when the number of
+	# messages in a category over the last WindowLength seconds reached the message threshold.
+	'''
+	CREATE TABLE IF NOT EXISTS LiveHighlight
+	(
+	Id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	ChannelId INTEGER NOT NULL,
+	Timestamp TIMESTAMP NOT NULL,
+	UnixTimestamp INTEGER NOT NULL,
+	CategoryName TEXT NOT NULL,
+	NumMessages INTEGER NOT NULL,
+	WindowLength INTEGER NOT NULL,
+
+	FOREIGN KEY (ChannelId) REFERENCES Channel (Id)
+	);
+
+	CREATE INDEX IF NOT EXISTS LiveHighlightChannelIndex ON LiveHighlight (ChannelId, UnixTimestamp);
+	''',
+
+	# Version 7: a partial index with the chat messages that aren't assigned to a VOD yet (e.g. the ones saved by bot.py),
+	# used by highlight.py to assign them when it finds new VODs using the Twitch API. Since most messages are assigned on
+	# the first run, this index stays small and later runs can skip the channel's previously assigned messages.
+	'''
+	CREATE INDEX IF NOT EXISTS ChatUnassignedIndex ON Chat (ChannelId, Timestamp) WHERE VideoId IS NULL;
+	''',
+
+	# Version 8: the videos found by highlight.py using the Twitch API for each channel and VOD type. The listing is complete for
+	# any videos created on or after BeginDate, and NewestCreatedAt is the creation time of the newest video that was listed,
+	# meaning later runs only have to request the videos that are newer than it. Both creation times use the API's format.
+	'''
+	CREATE TABLE IF NOT EXISTS ListedVideo
+	(
+	ChannelId INTEGER NOT NULL,
+	VodType VARCHAR(10) NOT NULL,
+	TwitchId VARCHAR(50) NOT NULL,
+	Title TEXT NOT NULL,
+	CreatedAt VARCHAR(20) NOT NULL,
+	Duration VARCHAR(20) NOT NULL,
+
+	PRIMARY KEY (ChannelId, VodType, TwitchId),
+	FOREIGN KEY (ChannelId) REFERENCES Channel (Id)
+	);
+
+	CREATE INDEX IF NOT EXISTS ListedVideoCreationIndex ON ListedVideo (ChannelId, VodType, CreatedAt);
+
+	CREATE TABLE IF NOT EXISTS VideoListing
+	(
+	ChannelId INTEGER NOT NULL,
+	VodType VARCHAR(10) NOT NULL,
+	BeginDate DATE NOT NULL,
+	NewestCreatedAt VARCHAR(20),
+	UpdateTime TIMESTAMP NOT NULL,
+
+	PRIMARY KEY (ChannelId, VodType),
+	FOREIGN KEY (ChannelId) REFERENCES Channel (Id)
+	);
+	''',
+
+	# Version 9: the lowercase words in every chat message, where each one is identified by an integer ID that never changes.
+	# If enabled, import.py and bot.py also save the IDs of each message's words (split by whitespace) as little-endian 32-bit
+	# integers, which lets highlight.py count the messages without reading their text.
+	'''
+	CREATE TABLE IF NOT EXISTS Vocabulary
+	(
+	Id INTEGER NOT NULL PRIMARY KEY,
+	Word TEXT NOT NULL UNIQUE
+	);
+
+	ALTER TABLE Chat ADD COLUMN WordIds BLOB;
+	''',
+
+	# Version 10: the catalog of chat shards, which are separate database files (one per month) where bot.py saves the chat messages
+	# instead of the main Chat table when the chat_shard_path option is set. Each shard contains the messages whose Unix time is
+	# between BeginUnixTime (inclusive) and EndUnixTime (exclusive), and is only attached when it's needed by highlight.py.
+	'''
+	CREATE TABLE IF NOT EXISTS ChatShard
+	(
+	Name VARCHAR(20) NOT NULL PRIMARY KEY,
+	BeginUnixTime INTEGER NOT NULL,
+	EndUnixTime INTEGER NOT NULL
+	);
+	''',
+
+	# Version 11: the chat of any VODs that were compacted by compact.py, where each VOD's messages are removed from the Chat table and
+	# saved in a single compressed stream (see compress_chat()). NumMessages and MaxId keep the same chat fingerprint as before the
+	# messages were compacted. The zlib format may use one of the shared dictionaries trained on previous chat messages.
+	'''
+	CREATE TABLE IF NOT EXISTS CompressionDictionary
+	(
+	Id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+	Data BLOB NOT NULL,
+	CreationTime TIMESTAMP NOT NULL
+	);
+
+	CREATE TABLE IF NOT EXISTS CompactedChat
+	(
+	VideoId INTEGER NOT NULL PRIMARY KEY,
+	Format VARCHAR(10) NOT NULL,
+	DictionaryId INTEGER,
+	NumMessages INTEGER NOT NULL,
+	MaxId INTEGER NOT NULL,
+	RawSize INTEGER NOT NULL,
+	Data BLOB NOT NULL,
+	CompactionTime TIMESTAMP NOT NULL,
+
+	FOREIGN KEY (VideoId) REFERENCES Video (Id),
+	FOREIGN KEY (DictionaryId) REFERENCES CompressionDictionary (Id)
+	);
+	''',
+]
+
+def split_sql_script(script: str) -> List[str]:
+	""" Splits a script into its SQL statements so that they can be executed one at a time inside a transaction, which executescript()
+	doesn't allow since it commits any pending transaction first. """
+
+	statement_list = []
+	statement = ''
+
+	for piece in script.split(';')[:-1]:
+		
+		# A semicolon may also appear inside a string or a trigger body, meaning the statement isn't over yet.
+		statement += piece + ';'
+		if sqlite3.complete_statement(statement):
+			statement_list.append(statement.strip())
+			statement = ''
+
+	return statement_list
+
+def migrate_database(db: sqlite3.Connection) -> int:
+	""" Applies any schema migrations that are missing from a database and returns its final version. Several scripts may connect to
+	the same database at once, so the version is only trusted after locking the database for writing. """
+
+	version = db.execute('PRAGMA user_version;').fetchone()[0]
+
+	while version < len(DATABASE_MIGRATIONS):
+		
+		# Each migration and its version number are applied atomically so that an interrupted upgrade can be resumed. If another
+		# script applied this migration while we were waiting for the lock, the new version is read and the loop moves on.
+		try:
+			db.execute('BEGIN IMMEDIATE;')
+			version = db.execute('PRAGMA user_version;').fetchone()[0]
+
+			if version < len(DATABASE_MIGRATIONS):
+				for statement in split_sql_script(DATABASE_MIGRATIONS[version]):
+					db.execute(statement)
+				
+				version += 1
+				db.execute(f'PRAGMA user_version = {version};')
+
+			db.execute('COMMIT;')
+
+		except sqlite3.Error:
+			if db.in_transaction:
+				db.execute('ROLLBACK;')
+			raise
+
+	return version
+
+def defer_indexes(db: sqlite3.Connection, table: str, keep_list: List[str]) -> int:
+	""" Drops every secondary index in a table (except the ones in the keep list) so that they can be rebuilt in one pass after a bulk
+	load. Returns the number of dropped indexes. Their definitions are kept in the database until restore_deferred_indexes() is called. """
+
+	cursor = db.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL;", {'table': table})
+	index_list = [(name, sql) for name, sql in cursor if name not in keep_list]
+
+	db.execute('BEGIN;')
+	for name, sql in index_list:
+		db.execute('INSERT OR REPLACE INTO DeferredIndex (Name, Sql) VALUES (:name, :sql);', {'name': name, 'sql': sql})
+		db.execute(f'DROP INDEX "{name}";')
+	db.execute('COMMIT;')
+
+	return len(index_list)
+
+def restore_deferred_indexes(db: sqlite3.Connection) -> int:
+	""" Recreates any indexes that were dropped by defer_indexes() and returns their number. """
+
+	index_list = db.execute('SELECT Name, Sql FROM DeferredIndex;').fetchall()
+	
+	for name, sql in index_list:
+		try:
+			db.execute('BEGIN;')
+			
+			if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name;", {'name': name}).fetchone() is None:
+				db.execute(sql)
+			
+			db.execute('DELETE FROM DeferredIndex WHERE Name = :name;', {'name': name})
+			db.execute('COMMIT;')
+		except sqlite3.Error:
+			if db.in_transaction:
+				db.execute('ROLLBACK;')
+			raise
+
+	return len(index_list)
+
+# The characters besides letters and numbers that are part of a word in the chat search index. This is every ASCII punctuation
+# character except quotes, meaning the index splits ASCII messages into the same words as str.lower().split().
+CHAT_SEARCH_TOKEN_CHARS = '!#$%&()*+,-./:;<=>?@[\\]^_`{|}~'
+
+def create_chat_search_index(db: sqlite3.Connection) -> bool:
+	""" Creates a full-text index over the chat messages and the triggers that keep it up to date when messages are inserted, updated,
+	or deleted. Returns true if the index had to be built, or false if it already existed. """
+
+	if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ChatSearch';").fetchone() is not None:
+		return False
+
+	# The index only stores the words and the row IDs of each message. Their text is read from the Chat table.
+	tokenizer = f"unicode61 remove_diacritics 0 tokenchars '{CHAT_SEARCH_TOKEN_CHARS}'"
+
+	try:
+		db.execute('BEGIN;')
+		db.execute(f'''CREATE VIRTUAL TABLE ChatSearch USING fts5(Message, content = 'Chat', content_rowid = 'Id', tokenize = "{tokenizer}");''')
+		
+		db.execute('''
+					CREATE TRIGGER ChatSearchInsert AFTER INSERT ON Chat BEGIN
+						INSERT INTO ChatSearch (rowid, Message) VALUES (new.Id, new.Message);
+					END;
+					''')
+		
+		db.execute('''
+					CREATE TRIGGER ChatSearchDelete AFTER DELETE ON Chat BEGIN
+						INSERT INTO ChatSearch (ChatSearch, rowid, Message) VALUES ('delete', old.Id, old.Message);
+					END;
+					''')
+		
+		db.execute('''
+					CREATE TRIGGER ChatSearchUpdate AFTER UPDATE OF Message ON Chat BEGIN
+						INSERT INTO ChatSearch (ChatSearch, rowid, Message) VALUES ('delete', old.Id, old.Message);
+						INSERT INTO ChatSearch (rowid, Message) VALUES (new.Id, new.Message);
+					END;
+					''')
+		
+		db.execute('''INSERT INTO ChatSearch (ChatSearch) VALUES ('rebuild');''')
+		db.execute('COMMIT;')
+	except sqlite3.Error:
+		if db.in_transaction:
+			db.execute('ROLLBACK;')
+		raise
+
+	return True
+
+def drop_chat_search_index(db: sqlite3.Connection) -> bool:
+	""" Removes the full-text index created by create_chat_search_index() along with its triggers. Returns true if it existed. """
+
+	if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ChatSearch';").fetchone() is None:
+		return False
+
+	db.executescript('''
+					BEGIN;
+					DROP TRIGGER IF EXISTS ChatSearchInsert;
+					DROP TRIGGER IF EXISTS ChatSearchDelete;
+					DROP TRIGGER IF EXISTS ChatSearchUpdate;
+					DROP TABLE ChatSearch;
+					COMMIT;
+					''')
+
+	return True
+
+####################################################################################################
+
+# The prefix of every chat shard's name, which is also its schema name when attached and its file name without the extension.
+CHAT_SHARD_PREFIX = 'chat_'
+
+# The messages in each shard start at a different ID (the shard's month number times this value) so that the IDs of every message
+# are unique across the main database and its shards.
+CHAT_SHARD_ID_MULTIPLIER = 2 ** 40
+
+# The columns that are read from the main Chat table and every shard's Chat table, in the same order.
+CHAT_COLUMNS = 'Id, ChannelId, VideoId, Timestamp, Message, UnixTimestamp, VideoOffset, WordIds'
+
+def get_chat_shard_name(unix_time: int) -> str:
+	""" Returns the name of the chat shard that contains the messages sent at a given Unix time (in microseconds). Each shard contains
+	one calendar month (in UTC). """
+
+	value = datetime.fromtimestamp(unix_time // 1_000_000, timezone.utc)
+	return f'{CHAT_SHARD_PREFIX}{value.year:04}_{value.month:02}'
+
+def get_chat_shard_range(name: str) -> Tuple[int, int]:
+	""" Returns the first Unix time (in microseconds) of a chat shard and the first one of the next shard. """
+
+	year, month = (int(value) for value in name[len(CHAT_SHARD_PREFIX):].split('_'))
+	begin_datetime = datetime(year, month, 1, tzinfo=timezone.utc)
+	end_datetime = datetime(year + 1, 1, 1, tzinfo=timezone.utc) if month == 12 else datetime(year, month + 1, 1, tzinfo=timezone.utc)
+	return convert_datetime_to_unix_time(begin_datetime), convert_datetime_to_unix_time(end_datetime)
+
+def find_chat_shards(db: sqlite3.Connection, time_ranges: List[Tuple[int, int]]) -> List[str]:
+	""" Returns the names of the chat shards in the catalog that overlap any of the given Unix time ranges (in microseconds). """
+
+	name_set = set()
+	for begin_unix_time, end_unix_time in time_ranges:
+		cursor = db.execute('SELECT Name FROM ChatShard WHERE BeginUnixTime <= :end_unix_time AND EndUnixTime > :begin_unix_time;',
+							{'begin_unix_time': begin_unix_time, 'end_unix_time': end_unix_time})
+		name_set.update(row[0] for row in cursor)
+
+	return sorted(name_set)
+
+def get_attached_chat_shards(db: sqlite3.Connection) -> List[str]:
+	return [row[1] for row in db.execute('PRAGMA database_list;') if row[1].startswith(CHAT_SHARD_PREFIX)]
+
+def attach_chat_shards(db: sqlite3.Connection, shard_path: Optional[str], name_list: List[str], create: bool = False, read_only: bool = False) -> None:
+	""" Attaches the chat shards with the given names and detaches any others. If create is true, any new shards are created and added to
+	the catalog. If read_only is true, the database must have been opened using a URI. Also recreates the temporary AllChat view, which
+	combines the main Chat table with the Chat table of every attached shard. Must not be called during a transaction. """
+
+	attached_list = get_attached_chat_shards(db)
+
+	db.execute('DROP VIEW IF EXISTS temp.AllChat;')
+
+	for name in attached_list:
+		if name not in name_list:
+			db.execute(f'DETACH DATABASE {name};')
+
+	for name in name_list:
+		
+		if name in attached_list:
+			continue
+
+		assert shard_path is not None, 'The chat shard path is required to attach a shard.'
+		file_path = os.path.join(shard_path, name + '.db')
+
+		if create:
+			os.makedirs(shard_path, exist_ok=True)
+		elif not os.path.exists(file_path):
+			raise FileNotFoundError(f'The chat shard "{file_path}" does not exist.')
+
+		db.execute(f'ATTACH DATABASE :path AS {name};', {'path': Path(file_path).as_uri() + '?mode=ro' if read_only else file_path})
+		
+		if read_only:
+			continue
+
+		db.execute(f'PRAGMA {name}.synchronous = NORMAL;')
+		
+		if create:
+			
+			begin_unix_time, end_unix_time = get_chat_shard_range(name)
+			year, month = (int(value) for value in name[len(CHAT_SHARD_PREFIX):].split('_'))
+			first_id = ((year - 1970) * 12 + month - 1) * CHAT_SHARD_ID_MULTIPLIER
+			
+			db.execute(f'PRAGMA {name}.journal_mode = WAL;')
+
+			try:
+				db.execute('BEGIN;')
+				
+				db.execute(f'''
+							CREATE TABLE IF NOT EXISTS {name}.Chat
+							(
+							Id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+							ChannelId INTEGER NOT NULL,
+							VideoId INTEGER,
+							Timestamp TIMESTAMP NOT NULL,
+							Message TEXT NOT NULL,
+							UnixTimestamp INTEGER,
+							VideoOffset INTEGER,
+							WordIds BLOB
+							);
+							''')
+
+				db.execute(f'CREATE INDEX IF NOT EXISTS {name}.ChatVideoIndex ON Chat (VideoId, Timestamp);')
+				db.execute(f'CREATE INDEX IF NOT EXISTS {name}.ChatChannelIndex ON Chat (ChannelId, Timestamp);')
+				db.execute(f'CREATE INDEX IF NOT EXISTS {name}.ChatUnassignedIndex ON Chat (ChannelId, Timestamp) WHERE VideoId IS NULL;')
+				
+				db.execute(f'''
+							INSERT INTO {name}.sqlite_sequence (name, seq)
+							SELECT 'Chat', :first_id WHERE NOT EXISTS (SELECT 1 FROM {name}.sqlite_sequence WHERE name = 'Chat');
+							''', {'first_id': first_id})
+				
+				db.execute(	'''
+							INSERT OR IGNORE INTO ChatShard (Name, BeginUnixTime, EndUnixTime)
+							VALUES (:name, :begin_unix_time, :end_unix_time);
+							''', {'name': name, 'begin_unix_time': begin_unix_time, 'end_unix_time': end_unix_time})
+				
+				db.execute('COMMIT;')
+			except sqlite3.Error:
+				if db.in_transaction:
+					db.execute('ROLLBACK;')
+				raise
+
+	select_list = [f'SELECT {CHAT_COLUMNS} FROM main.Chat'] + [f'SELECT {CHAT_COLUMNS} FROM {name}.Chat' for name in sorted(name_list)]
+	db.execute(f'CREATE TEMP VIEW AllChat AS {" UNION ALL ".join(select_list)};')
+
+####################################################################################################
+
+class DatabaseIdCache():
+	""" Resolves channel names and VOD Twitch IDs to their database IDs, caching the results so that each one is only queried once.
+	Any cached VOD must be forgotten after its row is inserted, deleted, or overwritten. """
+
+	db: sqlite3.Connection
+	channel_ids: Dict[str, int]
+	video_ids: Dict[str, int]
+
+	def __init__(self, db: sqlite3.Connection):
+		self.db = db
+		self.channel_ids = {}
+		self.video_ids = {}
+
+	def get_channel_id(self, channel_name: str, insert: bool = False) -> Optional[int]:
+		""" Returns the database ID of a channel, optionally inserting it if it doesn't exist yet. """
+
+		channel_name = channel_name.lower()
+		
+		channel_id = self.channel_ids.get(channel_name)
+		if channel_id is not None:
+			return channel_id
+
+		if insert:
+			self.db.execute('INSERT OR IGNORE INTO Channel (Name) VALUES (:name);', {'name': channel_name})
+
+		row = self.db.execute('SELECT Id FROM Channel WHERE Name = :name;', {'name': channel_name}).fetchone()
+		if row is None:
+			return None
+
+		channel_id = self.channel_ids[channel_name] = row[0]
+		return channel_id
+
+	def get_video_id(self, twitch_id: str) -> Optional[int]:
+		""" Returns the database ID of a VOD. """
+
+		video_id = self.video_ids.get(twitch_id)
+		if video_id is not None:
+			return video_id
+
+		row = self.db.execute('SELECT Id FROM Video WHERE TwitchId = :twitch_id;', {'twitch_id': twitch_id}).fetchone()
+		if row is None:
+			return None
+
+		video_id = self.video_ids[twitch_id] = row[0]
+		return video_id
+
+	def forget_video(self, twitch_id: str) -> None:
+		self.video_ids.pop(twitch_id, None)
+
+	def forget_all(self) -> None:
+		self.channel_ids.clear()
+		self.video_ids.clear()
+
+class WordVocabulary():
+	""" Assigns stable integer IDs to the lowercase words in chat messages, which are stored in the Vocabulary table. IDs are never changed
+	or reused, meaning the cached words stay valid even when other processes add new ones. Any words that were added during a transaction
+	must be forgotten if it's rolled back. """
+
+	db: sqlite3.Connection
+	word_ids: Dict[str, int]
+	word_list: List[Optional[str]]
+
+	def __init__(self, db: sqlite3.Connection):
+		self.db = db
+		self.word_ids = {}
+		self.word_list = []
+
+	def load(self) -> None:
+		""" Reads any words that were added to the database since they were last read, where each word is at the position of its ID. """
+		
+		cursor = self.db.execute('SELECT Id, Word FROM Vocabulary WHERE Id >= :min_id ORDER BY Id;', {'min_id': len(self.word_list)})
+		for word_id, word in cursor:
+			self.word_list.extend([None] * (word_id - len(self.word_list)))
+			self.word_list.append(word)
+			self.word_ids[word] = word_id
+
+	def get_word_ids(self, word_list: List[str]) -> List[int]:
+		""" Returns the ID of each word, inserting any new ones into the database. """
+
+		id_list = []
+		for word in word_list:
+			
+			word_id = self.word_ids.get(word)
+			if word_id is None:
+				self.db.execute('INSERT OR IGNORE INTO Vocabulary (Word) VALUES (:word);', {'word': word})
+				word_id = self.word_ids[word] = self.db.execute('SELECT Id FROM Vocabulary WHERE Word = :word;', {'word': word}).fetchone()[0]
+			
+			id_list.append(word_id)
+
+		return id_list
+
+	def forget_all(self) -> None:
+		self.word_ids.clear()
+		self.word_list.clear()
+
+def encode_word_ids(word_ids: List[int]) -> bytes:
+	""" Converts a message's word IDs to the little-endian 32-bit integers stored in the Chat table. """
+
+	id_array = array('I', word_ids)
+	if sys.byteorder == 'big':
+		id_array.byteswap()
+	return id_array.tobytes()
+
+def decode_word_ids(data: bytes) -> array:
+	""" Converts the word IDs stored in the Chat table back to integers. """
+
+	id_array = array('I')
+	id_array.frombytes(data)
+	if sys.byteorder == 'big':
+		id_array.byteswap()
+	return id_array
+
+####################################################################################################
+
+# The compression formats of the chat in the CompactedChat table. Only zlib supports a preset dictionary.
+COMPACTED_CHAT_FORMATS = ['zlib', 'lzma']
+
+def _pack_array(typecode: str, values: Iterable[int]) -> bytes:
+	""" Converts a sequence of integers to little-endian bytes, prefixed by their length in bytes. """
+
+	value_array = array(typecode, values)
+	if sys.byteorder == 'big':
+		value_array.byteswap()
+	data = value_array.tobytes()
+	return struct.pack('<Q', len(data)) + data
+
+def _unpack_array(typecode: str, view: memoryview, position: int) -> Tuple[array, int]:
+	""" Reads the integers saved by _pack_array() at a given position, and returns them along with the position that follows them. """
+
+	data, position = _unpack_bytes(view, position)
+	value_array = array(typecode)
+	value_array.frombytes(data)
+	if sys.byteorder == 'big':
+		value_array.byteswap()
+	return value_array, position
+
+def _unpack_bytes(view: memoryview, position: int) -> Tuple[memoryview, int]:
+	size, = struct.unpack_from('<Q', view, position)
+	position += 8
+	return view[position:position + size], position + size
+
+def compress_chat(row_list: List[tuple], compression_format: str, dictionary: Optional[bytes]) -> bytes:
+	""" Compresses a VOD's chat messages into a single stream, where each row has the message's ID, Unix timestamp, offset relative to the
+	VOD (both in microseconds), text, and word IDs (or None). The values are saved in columns since they compress better than rows, with
+	the message text first since a zlib dictionary only helps at the beginning of the stream. """
+
+	message_list = [row[3].encode('utf-8') for row in row_list]
+	word_ids_list = [row[4] for row in row_list]
+
+	# The IDs and timestamps are saved as the difference from the previous row, which are small and repetitive numbers.
+	id_list = [row[0] for row in row_list]
+	unix_timestamp_list = [row[1] for row in row_list]
+
+	data = b''.join([
+		struct.pack('<Q', sum(len(message) for message in message_list)),
+		*message_list,
+		_pack_array('I', [len(message) for message in message_list]),
+		_pack_array('q', [current - previous for previous, current in zip([0] + id_list, id_list)]),
+		_pack_array('q', [current - previous for previous, current in zip([0] + unix_timestamp_list, unix_timestamp_list)]),
+		_pack_array('q', [row[2] for row in row_list]),
+		_pack_array('i', [-1 if word_ids is None else len(word_ids) for word_ids in word_ids_list]),
+		struct.pack('<Q', sum(len(word_ids) for word_ids in word_ids_list if word_ids is not None)),
+		*[word_ids for word_ids in word_ids_list if word_ids is not None],
+	])
+
+	if compression_format == 'zlib':
+		compressor = zlib.compressobj(9, zdict=dictionary) if dictionary else zlib.compressobj(9)
+		return compressor.compress(data) + compressor.flush()
+	elif compression_format == 'lzma':
+		return lzma.compress(data, preset=6)
+	else:
+		raise ValueError(f'Unknown compression format "{compression_format}".')
+
+def decompress_chat(data: bytes, compression_format: str, dictionary: Optional[bytes]) -> List[tuple]:
+	""" Decompresses the chat messages saved by compress_chat() and returns the rows in their original order. """
+
+	if compression_format == 'zlib':
+		decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+		data = decompressor.decompress(data) + decompressor.flush()
+	elif compression_format == 'lzma':
+		data = lzma.decompress(data)
+	else:
+		raise ValueError(f'Unknown compression format "{compression_format}".')
+
+	view = memoryview(data)
+	position = 0
+
+	message_data, position = _unpack_bytes(view, position)
+	message_lengths, position = _unpack_array('I', view, position)
+	id_deltas, position = _unpack_array('q', view, position)
+	unix_timestamp_deltas, position = _unpack_array('q', view, position)
+	video_offsets, position = _unpack_array('q', view, position)
+	word_ids_lengths, position = _unpack_array('i', view, position)
+	word_ids_data, position = _unpack_bytes(view, position)
+
+	message_bytes = bytes(message_data)
+	word_ids_bytes = bytes(word_ids_data)
+	
+	row_list = []
+	message_position = 0
+	word_ids_position = 0
+
+	for message_id, unix_timestamp, video_offset, message_length, word_ids_length in zip(accumulate(id_deltas), accumulate(unix_timestamp_deltas), video_offsets, message_lengths, word_ids_lengths):
+		
+		message = message_bytes[message_position:message_position + message_length].decode('utf-8')
+		message_position += message_length
+
+		if word_ids_length >= 0:
+			word_ids = word_ids_bytes[word_ids_position:word_ids_position + word_ids_length]
+			word_ids_position += word_ids_length
+		else:
+			word_ids = None
+
+		row_list.append((message_id, unix_timestamp, video_offset, message, word_ids))
+
+	return row_list
+
+####################################################################################################
+
+class Category():
+
+	# From the config file.
+	name: str
+	words: List[str]
+	top: int
+	color: str
+	skip_summary: bool
+
+	# Determined at runtime.
+	search_words: List[Union[str, Pattern]]
+	words_hash: str
+	frequency_index: int
+
+	# For the CategoryBalance subclass in highlight.py.
+	positive_words: List[str]
+	negative_words: List[str]
+	comparison: 'CategoryComparison'
+	comparison_name: str
+	comparison_kind: str
+
+	def __init__(self, **kwargs):
+		
+		self.words = []
+		self.skip_summary = False
+		self.__dict__.update(kwargs)
+	
+		self.search_words = []
+		for word in self.words:
+			
+			if word.startswith('regex:'):
+				_, word = word.split('regex:', 1)
+				word = re.compile(word, re.IGNORECASE)
+			else:
+				word = word.lower()
+			
+			self.search_words.append(word)
+
+		# Identifies the category's cached message counts, regardless of its name or the order of its words.
+		self.words_hash = hashlib.sha256(json.dumps(sorted(self.words)).encode()).hexdigest()
+
+class CategoryMatcher():
+	""" Matches chat messages against a list of categories, where each one defines its search words as either lowercase strings
+	or compiled regular expressions. A message counts once for every category that matches at least one of its words. """
+
+	categories: list
+
+	# Determined at runtime.
+	literal_map: Dict[str, FrozenSet[int]]
+	pattern_list: List[Tuple[int, Pattern]]
+	token_cache: Dict[str, FrozenSet[int]]
+	max_cache_size: int
+
+	# For profiling.
+	num_tokens: int
+	num_pattern_evaluations: int
+
+	def __init__(self, categories: list, max_cache_size: int = 1_000_000):
+
+		self.categories = categories
+		self.max_cache_size = max_cache_size
+
+		literal_map: Dict[str, set] = {}
+		self.pattern_list = []
+
+		for i, category in enumerate(categories):
+
+			mergeable_patterns = []
+
+			for search_word in category.search_words:
+				if isinstance(search_word, str):
+					literal_map.setdefault(search_word, set()).add(i)
+				elif search_word.groups == 0:
+					mergeable_patterns.append(search_word)
+				else:
+					# Patterns with groups are kept separate since merging them could change their backreference numbers.
+					self.pattern_list.append((i, search_word))
+
+			if mergeable_patterns:
+				# The original patterns are anchored at the start of the word (see Pattern.match), which is also true for the
+				# alternation as a whole. The flags are the same for every pattern (see Category).
+				merged_source = '|'.join(f'(?:{pattern.pattern})' for pattern in mergeable_patterns)
+				try:
+					self.pattern_list.append((i, re.compile(merged_source, mergeable_patterns[0].flags)))
+				except re.error:
+					self.pattern_list.extend((i, pattern) for pattern in mergeable_patterns)
+
+		self.literal_map = {word: frozenset(indexes) for word, indexes in literal_map.items()}
+		self.token_cache = {}
+
+		self.num_tokens = 0
+		self.num_pattern_evaluations = 0
+
+	def match_token(self, token: str) -> FrozenSet[int]:
+		""" Returns the indexes of every category matched by a lowercase word. """
+
+		result = self.token_cache.get(token)
+		if result is not None:
+			return result
+
+		indexes = set(self.literal_map.get(token, ()))
+		for i, pattern in self.pattern_list:
+			if i not in indexes:
+				self.num_pattern_evaluations += 1
+				if pattern.match(token):
+					indexes.add(i)
+
+		result = frozenset(indexes)
+		
+		# Chat vocabulary is very skewed towards a few common words and emotes, so we don't need to cache every one of them.
+		if len(self.token_cache) < self.max_cache_size:
+			self.token_cache[token] = result
+
+		return result
+
+	def match_message_indexes(self, message: str) -> List[int]:
+		""" Returns the indexes of every category matched by a chat message, in ascending order. """
+
+		indexes: set = set()
+		token_set = set(message.lower().split())
+		self.num_tokens += len(token_set)
+
+		for token in token_set:
+			indexes.update(self.match_token(token))
+
+		return sorted(indexes)
+
+	def match_message(self, message: str) -> list:
+		""" Returns every category matched by a chat message, in the same order as they were passed to the constructor. """
+		return [self.categories[i] for i in self.match_message_indexes(message)]
+
+####################################################################################################
+
+class ChatLogReader():
+	""" Reads a JSON chat log incrementally so that its chat messages can be processed without loading the whole file into memory.
+	The top-level object's values before the comments list are returned by read_header(), each chat message is then yielded by
+	read_comments(), and any values after the list are returned by read_trailer(). """
+
+	file: TextIO
+	read_size: int
+
+	# Determined at runtime.
+	buffer: str
+	position: int
+	end_of_file: bool
+	in_comments: bool
+
+	WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+	def __init__(self, file: TextIO, read_size: int = 1 << 20):
+		self.file = file
+		self.read_size = read_size
+		self.buffer = ''
+		self.position = 0
+		self.end_of_file = False
+		self.in_comments = False
+		self.decoder = json.JSONDecoder()
+
+	def _read_more(self) -> bool:
+
+		if self.end_of_file:
+			return False
+
+		text = self.file.read(self.read_size)
+		if not text:
+			self.end_of_file = True
+			return False
+
+		# Discard anything that was already parsed.
+		self.buffer = self.buffer[self.position:] + text
+		self.position = 0
+		return True
+
+	def _peek(self) -> str:
+		""" Skips any whitespace and returns the next character, or an empty string at the end of the file. """
+
+		while True:
+			self.position = self.WHITESPACE.match(self.buffer, self.position).end()
+			if self.position < len(self.buffer):
+				return self.buffer[self.position]
+			elif not self._read_more():
+				return ''
+
+	def _decode(self) -> Any:
+		""" Decodes the next JSON value, reading more of the file until the value is complete. """
+
+		self._peek()
+
+		while True:
+			
+			# A value that ends exactly at the end of the buffer might be incomplete (e.g. a number that was cut in half).
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.position)
+				if end < len(self.buffer) or self.end_of_file:
+					self.position = end
+					return value
+			except json.JSONDecodeError:
+				if self.end_of_file:
+					raise
+
+			self._read_more()
+
+	def _next_key(self) -> Optional[str]:
+		""" Returns the next key in the top-level object, or None if there are no more keys. """
+
+		character = self._peek()
+		if character == ',':
+			self.position += 1
+			character = self._peek()
+
+		if character == '}':
+			self.position += 1
+			return None
+		elif character != '"':
+			raise ValueError(f'Expected a key in the chat log\'s top-level object but found "{character}".')
+
+		key = self._decode()
+
+		if self._peek() != ':':
+			raise ValueError(f'Expected a colon after the key "{key}" in the chat log\'s top-level object.')
+		self.position += 1
+		
+		return key
+
+	def read_header(self) -> dict:
+		""" Returns every top-level value that comes before the comments list. """
+
+		if self._peek() != '{':
+			raise ValueError('The chat log is not a dictionary.')
+		self.position += 1
+
+		header = {}
+		while True:
+			
+			key = self._next_key()
+			if key is None:
+				break
+
+			if key == 'comments' and self._peek() == '[':
+				self.position += 1
+				self.in_comments = True
+				break
+
+			header[key] = self._decode()
+
+		return header
+
+	def read_comments(self) -> Iterator[dict]:
+		""" Yields each chat message in the comments list. Must be called after read_header(). """
+
+		while self.in_comments:
+			
+			character = self._peek()
+			if character == ',':
+				self.position += 1
+			elif character == ']':
+				self.position += 1
+				self.in_comments = False
+			elif character == '':
+				raise ValueError('The chat log ended before the end of the comments list.')
+			else:
+				yield self._decode()
+
+	def read_trailer(self) -> dict:
+		""" Returns every top-level value that comes after the comments list. Must be called after read_comments(). """
+
+		trailer = {}
+		while True:
+			
+			key = self._next_key()
+			if key is None:
+				break
+
+			trailer[key] = self._decode()
+
+		return trailer
+
+####################################################################################################
+
 def split_twitch_duration(duration: str) -> Tuple[int, int, int, int]:
 
 	# Duration format: 00h00m00s or 00m00s
@@ -116,4 +1098,140 @@ def convert_twitch_timestamp_to_datetime(timestamp: str) -> datetime:
 		timestamp = beginning + '.' + microseconds[:6].ljust(6, '0') + 'Z'
 	
 	timestamp = timestamp.replace('Z', '+00:00')
-	return datetime.fromisoformat(timestamp)
\ No newline at end of file
+	return datetime.fromisoformat(timestamp)
+
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def convert_datetime_to_unix_time(value: datetime) -> int:
+	""" Converts a datetime into the number of microseconds since the Unix epoch. Naive datetimes are assumed to be in UTC. """
+
+	if value.tzinfo is None:
+		value = value.replace(tzinfo=timezone.utc)
+
+	delta = value - UNIX_EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+@lru_cache(maxsize=4096)
+def _format_unix_seconds(seconds: int) -> str:
+	return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+def format_unix_time(unix_time: int) -> str:
+	""" Formats a number of microseconds since the Unix epoch using the database's text timestamp format. """
+	
+	# Consecutive chat messages tend to be sent during the same second, so we only have to format the fractional part.
+	seconds, microseconds = divmod(unix_time, 1_000_000)
+	return f'{_format_unix_seconds(seconds)}.{microseconds:06}'
+
+####################################################################################################
+
+class Profiler():
+	""" Measures the time spent in each named stage of a script and counts events like the number of messages read. Stages and
+	counters are meant to be used around chunks of work (e.g. a VOD or a batch of messages) and do nothing unless the profiler
+	is enabled. """
+
+	enabled: bool
+	stage_times: Dict[str, float]
+	stage_calls: Dict[str, int]
+	counters: Dict[str, int]
+
+	start_time: float
+	python_profiler: Any
+
+	def __init__(self):
+		self.enabled = False
+		self.stage_times = {}
+		self.stage_calls = {}
+		self.counters = {}
+		self.start_time = 0.0
+		self.python_profiler = None
+
+	def start(self, use_python_profiler: bool = False) -> None:
+		""" Enables the profiler and optionally runs Python's own profiler (cProfile) until finish() is called. """
+
+		self.enabled = True
+		self.start_time = time.perf_counter()
+
+		if use_python_profiler:
+			import cProfile
+			self.python_profiler = cProfile.Profile()
+			self.python_profiler.enable()
+
+	@contextmanager
+	def stage(self, name: str) -> Iterator[None]:
+		
+		if not self.enabled:
+			yield
+			return
+
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.stage_times[name] = self.stage_times.get(name, 0.0) + time.perf_counter() - start_time
+			self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+	def count(self, name: str, amount: int = 1) -> None:
+		if self.enabled:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def take_snapshot(self) -> dict:
+		""" Returns and resets the current stage times and counters. Used to send the results of a worker process to the main one. """
+
+		snapshot = {'stage_times': self.stage_times, 'stage_calls': self.stage_calls, 'counters': self.counters}
+		self.stage_times, self.stage_calls, self.counters = {}, {}, {}
+		return snapshot
+
+	def merge(self, snapshot: dict) -> None:
+		""" Adds the stage times and counters from another profiler's snapshot. """
+
+		for name, seconds in snapshot['stage_times'].items():
+			self.stage_times[name] = self.stage_times.get(name, 0.0) + seconds
+		for name, calls in snapshot['stage_calls'].items():
+			self.stage_calls[name] = self.stage_calls.get(name, 0) + calls
+		for name, amount in snapshot['counters'].items():
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def finish(self, report_name: str) -> None:
+		""" Prints the time spent in each stage and the counters, and saves them to a JSON file. If cProfile was used, its results are
+		saved to a file that can be read by the pstats module or tools like SnakeViz. """
+
+		if not self.enabled:
+			return
+
+		total_time = time.perf_counter() - self.start_time
+
+		print()
+		print(f'Profile ({total_time:.3f} seconds in total). Stages can overlap and include the time spent in worker processes, so their sum may be larger:')
+		print()
+		print(f'{"Stage":<24} {"Calls":>10} {"Seconds":>12} {"Total":>8}')
+
+		for name, seconds in sorted(self.stage_times.items(), key=lambda x: x[1], reverse=True):
+			print(f'{name:<24} {self.stage_calls[name]:>10} {seconds:>12.3f} {seconds / total_time:>8.1%}')
+
+		if self.counters:
+			print()
+			print(f'{"Counter":<24} {"Value":>10} {"Per Second":>12}')
+			for name, amount in sorted(self.counters.items()):
+				print(f'{name:<24} {amount:>10} {amount / total_time:>12.0f}')
+
+		report = {
+			'total_time': total_time,
+			'stages': {name: {'seconds': seconds, 'calls': self.stage_calls[name]} for name, seconds in self.stage_times.items()},
+			'counters': self.counters,
+		}
+
+		report_path = f'{report_name}_profile.json'
+		with open(report_path, 'w', encoding='utf-8') as file:
+			json.dump(report, file, indent='\t')
+
+		print()
+		print(f'Saved the profile to "{report_path}".')
+
+		if self.python_profiler is not None:
+			self.python_profiler.disable()
+			python_profile_path = f'{report_name}_profile.prof'
+			self.python_profiler.dump_stats(python_profile_path)
+			print(f'Saved the cProfile results to "{python_profile_path}".')
+
+# Shared by every script so that any function can add to the same profile.
+profiler = Profiler()
\ No newline at end of file
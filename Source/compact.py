@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from common import COMPACTED_CHAT_FORMATS, CommonConfig, attach_chat_shards, compress_chat, decompress_chat, find_chat_shards, get_attached_chat_shards, split_twitch_duration, convert_datetime_to_unix_time
+
+# How many chat messages are used to train a new compression dictionary.
+DICTIONARY_SAMPLE_SIZE = 100_000
+
+def train_compression_dictionary(message_list: List[str], size: int) -> bytes:
+	""" Builds a zlib dictionary from the most common messages and words in a sample of chat messages. The strings that save the most bytes
+	are placed at the end of the dictionary, since zlib can refer to them using shorter distances. """
+
+	counter = Counter(message_list)
+	counter.update(word + ' ' for message in message_list for word in message.split())
+
+	# Only strings that appear more than once are worth including.
+	score_list = sorted(((count * len(text.encode('utf-8')), text) for text, count in counter.items() if count > 1 and text), reverse=True)
+
+	piece_list = []
+	dictionary_size = 0
+
+	for _, text in score_list:
+
+		piece = text.encode('utf-8')
+		if dictionary_size + len(piece) > size:
+			continue
+
+		piece_list.append(piece)
+		dictionary_size += len(piece)
+
+	return b''.join(reversed(piece_list))
+
+def get_raw_chat_size(row_list: List[tuple]) -> int:
+	""" Returns the size in bytes of the values in a VOD's chat rows before being compressed (three 64-bit integers, the UTF-8 message, and
+	the word IDs). """
+	return sum(24 + len(row[3].encode('utf-8')) + len(row[4] or b'') for row in row_list)
+
+def format_size(num_bytes: float) -> str:
+	return f'{num_bytes / 1_000_000:.2f} MB'
+
+if __name__ == '__main__':
+
+	parser = ArgumentParser(description='Moves the chat messages of any VODs that ended a while ago from the Chat table into a single compressed stream per VOD. These messages are still read by highlight.py, but take less space and are read faster since every message in a VOD is decompressed at once.')
+	parser.add_argument('-channel', help='Only compact the VODs of this channel. If omitted, the VODs of every channel are compacted.')
+	parser.add_argument('-min-age', type=float, default=7, help='How many days must have passed since a VOD ended before its chat is compacted. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-min-live-age', type=float, default=60, help='How many days must have passed since a VOD ended before its chat is compacted if it wasn\'t imported from a chat log (e.g. messages saved by bot.py). While Twitch still lists the VOD, highlight.py may move these messages to another VOD if its duration is corrected, which isn\'t possible once they\'re compacted. Twitch keeps VODs for at most 60 days. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-format', choices=COMPACTED_CHAT_FORMATS, default='zlib', help='The compression format. zlib is faster to read and can use a shared dictionary, while lzma is smaller. If omitted, this defaults to "%(default)s".')
+	parser.add_argument('-dictionary-size', type=int, default=32768, help='The maximum size in bytes of the shared dictionary that is trained on the chat messages when using zlib. Set this to zero to not use a dictionary. zlib can only use up to 32768 bytes. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-train-dictionary', action='store_true', help='Train a new dictionary on the VODs being compacted even if one already exists. Otherwise, the most recent one is used.')
+	parser.add_argument('-vacuum', action='store_true', help='Rebuild the database files at the end so that the space freed by the compacted messages is returned to the operating system.')
+	args = parser.parse_args()
+
+	config = CommonConfig()
+
+	try:
+		db = config.connect_to_database()
+		print(f'Connected to the database: {config.database_path}')
+	except sqlite3.Error as error:
+		print(f'Failed to connect to the database with the error: {repr(error)}')
+		sys.exit(1)
+
+	# Find every VOD that ended before the minimum age and that has messages in the Chat table. VODs that were compacted before are
+	# only compacted again if new messages were assigned to them. Any VOD that wasn't imported from a chat log is assumed to have its
+	# messages assigned by highlight.py, so it must also be older than the minimum live age.
+	unix_now = convert_datetime_to_unix_time(datetime.now(timezone.utc))
+	max_unix_end_time = unix_now - round(args.min_age * 86400 * 1_000_000)
+	max_live_unix_end_time = min(max_unix_end_time, unix_now - round(args.min_live_age * 86400 * 1_000_000))
+	video_list = []
+	num_live_videos = 0
+
+	try:
+		imported_twitch_ids = {row[0] for row in db.execute('SELECT DISTINCT VideoTwitchId FROM ImportedFile;')}
+
+		cursor = db.execute('''
+							SELECT V.Id, V.TwitchId, V.Title, V.UnixCreationTime, V.Duration
+							FROM Video V
+							INNER JOIN Channel CL ON V.ChannelId = CL.Id
+							WHERE :channel_name IS NULL OR CL.Name = :channel_name
+							ORDER BY V.CreationTime;
+							''', {'channel_name': args.channel})
+
+		for row in cursor.fetchall():
+
+			*_, duration_in_seconds = split_twitch_duration(row['Duration'])
+			time_range = (row['UnixCreationTime'], row['UnixCreationTime'] + duration_in_seconds * 1_000_000)
+
+			video_max_unix_end_time = max_unix_end_time if row['TwitchId'] in imported_twitch_ids else max_live_unix_end_time
+
+			if time_range[1] <= video_max_unix_end_time:
+				video_list.append((row, time_range))
+			elif time_range[1] <= max_unix_end_time:
+				num_live_videos += 1
+
+	except sqlite3.Error as error:
+		print(f'Failed to retrieve the videos with the error: {repr(error)}')
+		sys.exit(1)
+
+	if num_live_videos > 0:
+		print(f'Skipped {num_live_videos} VODs that weren\'t imported from a chat log and that ended less than {args.min_live_age:g} days ago, since their messages may still be reassigned.')
+
+	def read_chat(video_id: int, time_range: tuple) -> List[tuple]:
+		""" Reads a VOD's messages in the Chat table (including any chat shards that overlap it) in the same format as compress_chat(). """
+
+		if config.chat_shard_path is not None:
+			attach_chat_shards(db, config.chat_shard_path, find_chat_shards(db, [time_range]))
+
+		cursor = db.execute('''
+							SELECT
+								CT.Id,
+								CT.UnixTimestamp,
+								COALESCE(CT.VideoOffset, CT.UnixTimestamp - V.UnixCreationTime) AS VideoOffset,
+								CT.Message,
+								CT.WordIds
+							FROM AllChat CT
+							INNER JOIN Video V ON CT.VideoId = V.Id
+							WHERE V.Id = :video_id
+							ORDER BY CT.Timestamp;
+							''', {'video_id': video_id})
+
+		return [tuple(row) for row in cursor]
+
+	# Any new dictionary is trained on the first VODs that will be compacted.
+	dictionary_id: Optional[int] = None
+	dictionary: Optional[bytes] = None
+
+	if args.format == 'zlib' and args.dictionary_size > 0:
+		try:
+			row = db.execute('SELECT Id, Data FROM CompressionDictionary ORDER BY Id DESC LIMIT 1;').fetchone()
+
+			if row is not None and not args.train_dictionary:
+				dictionary_id, dictionary = row['Id'], row['Data']
+				print(f'Using the compression dictionary {dictionary_id} with {len(dictionary)} bytes.')
+			else:
+				sample_list: List[str] = []
+				for row, time_range in video_list:
+					if len(sample_list) >= DICTIONARY_SAMPLE_SIZE:
+						break
+					sample_list.extend(chat_row[3] for chat_row in read_chat(row['Id'], time_range))
+
+				dictionary = train_compression_dictionary(sample_list[:DICTIONARY_SAMPLE_SIZE], args.dictionary_size) or None
+
+				if dictionary is None:
+					print('Could not train a compression dictionary since there aren\'t enough repeated messages. The chat will be compressed without one.')
+				else:
+					cursor = db.execute('INSERT INTO CompressionDictionary (Data, CreationTime) VALUES (:data, CURRENT_TIMESTAMP);', {'data': dictionary})
+					dictionary_id = cursor.lastrowid
+					print(f'Trained the compression dictionary {dictionary_id} with {len(dictionary)} bytes using {len(sample_list[:DICTIONARY_SAMPLE_SIZE])} messages.')
+
+		except (sqlite3.Error, OSError) as error:
+			print(f'Failed to train the compression dictionary with the error: {repr(error)}')
+			sys.exit(1)
+
+	num_compacted_videos = 0
+	num_compacted_messages = 0
+	total_raw_size = 0
+	total_compressed_size = 0
+	total_read_time = 0.0
+	total_decompress_time = 0.0
+
+	for i, (video, time_range) in enumerate(video_list):
+
+		try:
+			# The time it takes to read the messages from the Chat table is compared with the time it takes to decompress them.
+			read_begin_time = time.perf_counter()
+			row_list = read_chat(video['Id'], time_range)
+			read_time = time.perf_counter() - read_begin_time
+
+			if not row_list:
+				continue
+
+			print()
+			print(f'- Compacting the chat of the VOD {i+1} of {len(video_list)} "{video["Title"]}" ({video["TwitchId"]}) with {len(row_list)} messages...')
+
+			# Any previously compacted messages are merged with the new ones.
+			compacted_row = db.execute('SELECT Format, DictionaryId, Data FROM CompactedChat WHERE VideoId = :video_id;', {'video_id': video['Id']}).fetchone()
+			if compacted_row is not None:
+
+				previous_dictionary = None
+				if compacted_row['DictionaryId'] is not None:
+					previous_dictionary = db.execute('SELECT Data FROM CompressionDictionary WHERE Id = :dictionary_id;', {'dictionary_id': compacted_row['DictionaryId']}).fetchone()[0]
+
+				previous_row_list = decompress_chat(compacted_row['Data'], compacted_row['Format'], previous_dictionary)
+				all_row_list = sorted(previous_row_list + row_list, key=lambda x: x[1])
+			else:
+				all_row_list = row_list
+
+			data = compress_chat(all_row_list, args.format, dictionary)
+			raw_size = get_raw_chat_size(all_row_list)
+
+			# Make sure that every message can be read back before removing them from the Chat table.
+			decompress_begin_time = time.perf_counter()
+			decompressed_row_list = decompress_chat(data, args.format, dictionary)
+			decompress_time = time.perf_counter() - decompress_begin_time
+
+			if decompressed_row_list != all_row_list:
+				print('- Skipping the VOD since the compacted messages are different from the original ones.')
+				continue
+
+			db.execute('BEGIN;')
+
+			db.execute(	'''
+						INSERT OR REPLACE INTO CompactedChat (VideoId, Format, DictionaryId, NumMessages, MaxId, RawSize, Data, CompactionTime)
+						VALUES (:video_id, :format, :dictionary_id, :num_messages, :max_id, :raw_size, :data, CURRENT_TIMESTAMP);
+						''',
+						{'video_id': video['Id'], 'format': args.format, 'dictionary_id': dictionary_id if args.format == 'zlib' else None,
+						 'num_messages': len(all_row_list), 'max_id': max(row[0] for row in all_row_list), 'raw_size': raw_size, 'data': data})
+
+			# If any messages were assigned to the VOD while it was being compacted (e.g. by highlight.py), they would be deleted without
+			# being saved, so the whole VOD is skipped instead.
+			num_deleted = 0
+			for schema in ['main'] + get_attached_chat_shards(db):
+				cursor = db.execute(f'DELETE FROM {schema}.Chat WHERE VideoId = :video_id;', {'video_id': video['Id']})
+				num_deleted += cursor.rowcount
+
+			if num_deleted != len(row_list):
+				db.execute('ROLLBACK;')
+				print(f'- Skipping the VOD since its chat changed while it was being compacted ({num_deleted} instead of {len(row_list)} messages).')
+				continue
+
+			db.execute('COMMIT;')
+
+		except (sqlite3.Error, OSError) as error:
+			if db.in_transaction:
+				db.execute('ROLLBACK;')
+			print(f'- Failed to compact the chat with the error: {repr(error)}')
+			continue
+
+		print(f'- Compressed {len(all_row_list)} messages from {format_size(raw_size)} to {format_size(len(data))} ({len(data) / raw_size:.1%} of the original size).')
+		print(f'- Read the messages in {read_time:.3f} seconds from the Chat table and in {decompress_time:.3f} seconds from the compacted chat.')
+
+		num_compacted_videos += 1
+		num_compacted_messages += len(all_row_list)
+		total_raw_size += raw_size
+		total_compressed_size += len(data)
+		total_read_time += read_time
+		total_decompress_time += decompress_time
+
+	print()
+
+	if num_compacted_videos > 0:
+
+		print(f'Compacted {num_compacted_messages} messages in {num_compacted_videos} VODs from {format_size(total_raw_size)} to {format_size(total_compressed_size)} ({total_compressed_size / total_raw_size:.1%} of the original size).')
+
+		for source, read_time in [('Chat table', total_read_time), ('compacted chat', total_decompress_time)]:
+			print(f'Reading every message from the {source} took {read_time:.2f} seconds ({num_compacted_messages / max(read_time, 1e-9):,.0f} messages/s, {format_size(total_raw_size / max(read_time, 1e-9))}/s).')
+	else:
+		print('Could not find any VODs to compact.')
+
+	if args.vacuum:
+		try:
+			for schema in ['main'] + get_attached_chat_shards(db):
+				print(f'Vacuuming the "{schema}" database...')
+				db.execute(f'VACUUM {schema};')
+		except sqlite3.Error as error:
+			print(f'Failed to vacuum the database with the error: {repr(error)}')
+
+	try:
+		db.close()
+	except sqlite3.Error as error:
+		print(f'Failed to close the database with the error: {repr(error)}')
+
+	print()
+	print('Finished running.')
@@ -1,54 +1,31 @@
 #!/usr/bin/env python3
 
-import re
+import hashlib
+import heapq
+import json
+import os
 import sqlite3
+import struct
 import sys
 from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
 from collections import namedtuple
-from datetime import datetime, timedelta
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import product
 from math import ceil, floor
-from typing import List, Pattern, Union
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import matplotlib # type: ignore
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt # type: ignore
+import numpy as np
 from matplotlib.ticker import AutoMinorLocator, MultipleLocator # type: ignore
 from twitch import Helix # type: ignore
 
-from common import CommonConfig, split_twitch_duration, convert_twitch_timestamp_to_datetime
-
-class Category():
-
-	# From the config file.
-	name: str
-	words: List[str]
-	top: int
-	color: str
-	skip_summary: bool
-
-	# Determined at runtime.
-	search_words: List[Union[str, Pattern]]
-
-	# For the CategoryBalance subclass.
-	positive_words: List[str]
-	negative_words: List[str]
-	comparison_name: str
-	comparison_kind: str
-
-	def __init__(self, **kwargs):
-		
-		self.words = []
-		self.skip_summary = False
-		self.__dict__.update(kwargs)
-	
-		self.search_words = []
-		for word in self.words:
-			
-			if word.startswith('regex:'):
-				_, word = word.split('regex:', 1)
-				word = re.compile(word, re.IGNORECASE)
-			else:
-				word = word.lower()
-			
-			self.search_words.append(word)
+from common import CHAT_SEARCH_TOKEN_CHARS, CommonConfig, Category, CategoryMatcher, DatabaseIdCache, WordVocabulary, profiler, attach_chat_shards, decode_word_ids, decompress_chat, find_chat_shards, get_attached_chat_shards, split_twitch_duration, convert_twitch_timestamp_to_datetime, convert_datetime_to_unix_time
 
 class CategoryBalance(Category):
 
@@ -76,10 +53,859 @@ class CategoryComparison():
 		self.skip_summary = False
 		self.__dict__.update(kwargs)
 
+def count_frequency(category_indexes: np.ndarray, buckets: np.ndarray, num_categories: int, num_buckets: int) -> np.ndarray:
+	""" Counts the number of matches per category and bucket, where each match is a pair of elements from the first two arrays.
+	Negative buckets wrap around like the indexes in a Python list. """
+
+	if buckets.size > 0 and (buckets.min() < -num_buckets or buckets.max() >= num_buckets):
+		raise IndexError('The bucket of a chat message is out of range.')
+
+	buckets = np.where(buckets < 0, buckets + num_buckets, buckets)
+	frequency = np.bincount(category_indexes * num_buckets + buckets, minlength=num_categories * num_buckets)
+	return frequency.reshape(num_categories, num_buckets)
+
+# The shared compression dictionaries that were read from the database in this process.
+compression_dictionaries: Dict[int, bytes] = {}
+
+def read_compacted_chat(db: sqlite3.Connection, video_id: int) -> List[dict]:
+	""" Returns a VOD's chat messages that were compacted by compact.py with the same columns as the queries in count_chat_frequency(),
+	or an empty list if the VOD wasn't compacted. """
+
+	row = db.execute('SELECT Format, DictionaryId, Data FROM CompactedChat WHERE VideoId = :video_id;', {'video_id': video_id}).fetchone()
+	if row is None:
+		return []
+
+	dictionary = None
+	if row['DictionaryId'] is not None:
+		dictionary = compression_dictionaries.get(row['DictionaryId'])
+		if dictionary is None:
+			cursor = db.execute('SELECT Data FROM CompressionDictionary WHERE Id = :dictionary_id;', {'dictionary_id': row['DictionaryId']})
+			dictionary = compression_dictionaries[row['DictionaryId']] = cursor.fetchone()[0]
+
+	chat_list = []
+	for _, unix_timestamp, video_offset, message, word_ids in decompress_chat(row['Data'], row['Format'], dictionary):
+		
+		# Same as SQLite's integer division, which rounds towards zero.
+		offset = video_offset // 1_000_000 if video_offset >= 0 else -(-video_offset // 1_000_000)
+		chat_list.append({'WordIds': word_ids, 'Message': message if word_ids is None else None, 'UnixTimestamp': unix_timestamp, 'Offset': offset})
+
+	return chat_list
+
+class CompactedChatCursor():
+	""" Reads a VOD's compacted chat messages followed by the ones returned by a database cursor, in the same way as the latter. """
+
+	compacted_chat_list: List[dict]
+	cursor: sqlite3.Cursor
+	position: int
+
+	def __init__(self, compacted_chat_list: List[dict], cursor: sqlite3.Cursor):
+		self.compacted_chat_list = compacted_chat_list
+		self.cursor = cursor
+		self.position = 0
+
+	def fetchmany(self, size: int) -> list:
+		
+		if self.position < len(self.compacted_chat_list):
+			chat_list = self.compacted_chat_list[self.position:self.position + size]
+			self.position += len(chat_list)
+			return chat_list
+		
+		return self.cursor.fetchmany(size)
+
+	def fetchall(self) -> list:
+		chat_list = self.compacted_chat_list[self.position:] + self.cursor.fetchall()
+		self.position = len(self.compacted_chat_list)
+		return chat_list
+
+def count_chat_frequency(db: sqlite3.Connection, matcher: CategoryMatcher, video_id: int, num_buckets: int, bucket_length: int, unix_time_range: Optional[Tuple[int, int]], search_query: Optional[str] = None) -> np.ndarray:
+	""" Counts the number of messages per category and bucket in a VOD's chat, where the categories are the ones in the matcher.
+	If a time range is given, every message must have been sent during it. If a search query is given, only the messages found
+	by the chat search index are read. The text of any messages that were saved with their word IDs is never read. """
+
+	with profiler.stage('fetch chat'):
+		if search_query is None:
+			cursor = db.execute('''
+								SELECT
+									CT.WordIds,
+									CASE WHEN CT.WordIds IS NULL THEN CT.Message END AS Message,
+									CT.UnixTimestamp,
+									COALESCE(CT.VideoOffset, CT.UnixTimestamp - V.UnixCreationTime) / 1000000 AS Offset
+								FROM AllChat CT
+								INNER JOIN Video V ON CT.VideoId = V.Id
+								INNER JOIN Channel CL ON V.ChannelId = CL.Id
+								WHERE V.Id = :video_id
+								ORDER BY CT.Timestamp;
+								''', {'video_id': video_id})
+		else:
+			cursor = db.execute('''
+								SELECT
+									CT.WordIds,
+									CASE WHEN CT.WordIds IS NULL THEN CT.Message END AS Message,
+									CT.UnixTimestamp,
+									COALESCE(CT.VideoOffset, CT.UnixTimestamp - V.UnixCreationTime) / 1000000 AS Offset
+								FROM AllChat CT
+								INNER JOIN Video V ON CT.VideoId = V.Id
+								WHERE V.Id = :video_id AND CT.Id IN (SELECT rowid FROM ChatSearch WHERE ChatSearch MATCH :search_query);
+								''', {'search_query': search_query, 'video_id': video_id})
+
+		# The messages compacted by compact.py are read first. These aren't in the search index, so all of them are matched below.
+		cursor = CompactedChatCursor(read_compacted_chat(db, video_id), cursor)
+
+	# Collect the category and bucket of every match, then count them all at once. The messages are read in chunks so that
+	# the time spent reading them can be measured separately from the time spent matching them. Messages with word IDs are
+	# collected and matched together at the end.
+	category_indexes = array('q')
+	buckets = array('q')
+	word_id_list: List[bytes] = []
+	word_id_offsets = array('q')
+
+	num_messages = 0
+	num_tokens = matcher.num_tokens
+	num_pattern_evaluations = matcher.num_pattern_evaluations
+
+	while True:
+
+		with profiler.stage('fetch chat'):
+			chat_list = cursor.fetchmany(10_000)
+
+		if not chat_list:
+			break
+
+		num_messages += len(chat_list)
+
+		with profiler.stage('match messages'):
+			for chat in chat_list:
+
+				if unix_time_range is not None:
+					begin_unix_time, end_unix_time = unix_time_range
+					assert begin_unix_time <= chat['UnixTimestamp'] <= end_unix_time, 'The chat message was not sent during the live stream.'
+
+				if chat['WordIds'] is not None:
+					word_id_list.append(chat['WordIds'])
+					word_id_offsets.append(chat['Offset'])
+					continue
+
+				# The search index may return messages where a word is only part of a longer one (e.g. due to quotes or non-ASCII
+				# characters), so these are always matched again.
+				matched_indexes = matcher.match_message_indexes(chat['Message'])
+				if matched_indexes:
+					bucket = floor(chat['Offset'] / bucket_length)
+					category_indexes.extend(matched_indexes)
+					buckets.extend([bucket] * len(matched_indexes))
+
+	all_category_indexes = np.frombuffer(category_indexes, dtype=np.int64)
+	all_buckets = np.frombuffer(buckets, dtype=np.int64)
+	num_word_ids = 0
+
+	if word_id_list:
+		
+		with profiler.stage('match messages'):
+			
+			word_ids = np.frombuffer(b''.join(word_id_list), dtype='<u4')
+			message_starts = np.zeros(len(word_id_list) + 1, dtype=np.int64)
+			np.cumsum([len(data) // 4 for data in word_id_list], out=message_starts[1:])
+			message_buckets = np.floor_divide(np.frombuffer(word_id_offsets, dtype=np.int64), bucket_length)
+			
+			vocabulary = get_vocabulary(db, int(word_ids.max()) + 1 if word_ids.size > 0 else 0)
+			word_id_category_indexes, word_id_buckets = match_word_ids(vocabulary, matcher, word_ids, message_starts, message_buckets)
+			
+			all_category_indexes = np.concatenate([all_category_indexes, word_id_category_indexes])
+			all_buckets = np.concatenate([all_buckets, word_id_buckets])
+			num_word_ids = word_ids.size
+
+	profiler.count('messages', num_messages)
+	profiler.count('tokens', matcher.num_tokens - num_tokens + num_word_ids)
+	profiler.count('pattern evaluations', matcher.num_pattern_evaluations - num_pattern_evaluations)
+	profiler.count('matches', all_buckets.size)
+
+	with profiler.stage('count buckets'):
+		return count_frequency(all_category_indexes, all_buckets, len(matcher.categories), num_buckets)
+
+# Increment this whenever the format of the chat archive files changes.
+CHAT_ARCHIVE_VERSION = 3
+
+# The word vocabulary of each database connection in this process.
+vocabulary_cache: Dict[sqlite3.Connection, WordVocabulary] = {}
+
+def get_vocabulary(db: sqlite3.Connection, min_size: int = 0) -> WordVocabulary:
+	""" Returns the word vocabulary of a database connection, reading any new words if it has fewer than a given number of them. """
+
+	vocabulary = vocabulary_cache.get(db)
+	if vocabulary is None:
+		vocabulary = vocabulary_cache[db] = WordVocabulary(db)
+		vocabulary.load()
+	elif len(vocabulary.word_list) < min_size:
+		vocabulary.load()
+
+	return vocabulary
+
+class ArchiveVocabulary():
+	""" The words used by the chat archives, which are saved to a vocabulary file shared by every VOD so that the archives can be counted
+	without reading the database. Each word is on the line given by its ID in the Vocabulary table (empty lines are IDs without a word).
+	Since these IDs never change, the file is only ever appended to. """
+
+	file_path: str
+	file_size: int
+	word_list: List[Optional[str]]
+
+	def __init__(self, archive_path: str):
+		self.file_path = os.path.join(archive_path, 'vocabulary.txt')
+		self.file_size = 0
+		self.word_list = []
+		self.load()
+
+	def load(self) -> None:
+		""" Reads the vocabulary file again. Any incomplete last line (e.g. if a previous run was interrupted) is ignored. """
+
+		try:
+			with open(self.file_path, encoding='utf-8', newline='') as file:
+				text = file.read()
+		except FileNotFoundError:
+			text = ''
+
+		text = text[:text.rfind('\n') + 1]
+		self.file_size = len(text.encode('utf-8'))
+		self.word_list = [word or None for word in text.split('\n')[:-1]]
+
+	def save(self, vocabulary: WordVocabulary, size: int) -> None:
+		""" Appends the words in the database's vocabulary whose IDs are lower than a given size and that aren't in the file yet. """
+
+		if len(self.word_list) >= size:
+			return
+
+		if len(vocabulary.word_list) < size:
+			vocabulary.load()
+
+		new_word_list = vocabulary.word_list[len(self.word_list):size]
+		
+		with open(self.file_path, 'ab') as file:
+			file.truncate(self.file_size)
+			data = ''.join((word or '') + '\n' for word in new_word_list).encode('utf-8')
+			file.write(data)
+
+		self.file_size += len(data)
+		self.word_list.extend(new_word_list)
+
+# The vocabulary of each archive directory in this process.
+archive_vocabulary_cache: Dict[str, ArchiveVocabulary] = {}
+
+def get_archive_vocabulary(archive_path: str, min_size: int = 0) -> ArchiveVocabulary:
+	""" Returns the vocabulary of an archive directory, reading the file again if it has fewer than a given number of words. """
+
+	vocabulary = archive_vocabulary_cache.get(archive_path)
+	if vocabulary is None:
+		vocabulary = archive_vocabulary_cache[archive_path] = ArchiveVocabulary(archive_path)
+	elif len(vocabulary.word_list) < min_size:
+		vocabulary.load()
+
+	return vocabulary
+
+def read_chat_archive_info(archive_path: str, twitch_id: str, chat_fingerprint: tuple) -> Optional[dict]:
+	""" Returns the information of a VOD's chat archive, or None if it doesn't exist or if the VOD's chat changed since it was created. """
+
+	info_path = os.path.join(archive_path, twitch_id, 'archive.json')
+
+	try:
+		with open(info_path, encoding='utf-8') as file:
+			info = json.load(file)
+	except (OSError, ValueError):
+		return None
+
+	if info.get('version') != CHAT_ARCHIVE_VERSION or tuple(info.get('fingerprint', ())) != tuple(chat_fingerprint):
+		return None
+
+	info['path'] = os.path.join(archive_path, twitch_id)
+	info['archive_path'] = archive_path
+	return info
+
+def write_chat_archive(db: sqlite3.Connection, archive_path: str, video_id: int, twitch_id: str, chat_fingerprint: tuple) -> dict:
+	""" Saves a VOD's chat to its archive directory and returns the archive's information. The archive contains the offset in seconds of
+	each message, the IDs of every word in every message (in the database's Vocabulary table), and the position of each message's first word.
+	Any new words are also added to the shared vocabulary file. """
+
+	vocabulary = get_vocabulary(db)
+	
+	offsets = array('i')
+	word_ids = array('I')
+	message_starts = array('Q', [0])
+	min_unix_timestamp = None
+	max_unix_timestamp = None
+
+	# The same messages and offsets as the ones read by count_chat_frequency(). Any new words are inserted in a single transaction.
+	try:
+		db.execute('BEGIN;')
+
+		cursor = db.execute('''
+							SELECT
+								CT.WordIds,
+								CASE WHEN CT.WordIds IS NULL THEN CT.Message END AS Message,
+								CT.UnixTimestamp,
+								COALESCE(CT.VideoOffset, CT.UnixTimestamp - V.UnixCreationTime) / 1000000 AS Offset
+							FROM AllChat CT
+							INNER JOIN Video V ON CT.VideoId = V.Id
+							INNER JOIN Channel CL ON V.ChannelId = CL.Id
+							WHERE V.Id = :video_id
+							ORDER BY CT.Timestamp;
+							''', {'video_id': video_id})
+
+		for chat in CompactedChatCursor(read_compacted_chat(db, video_id), cursor).fetchall():
+			
+			offsets.append(chat['Offset'])
+			
+			if chat['WordIds'] is not None:
+				word_ids.extend(decode_word_ids(chat['WordIds']))
+			else:
+				word_ids.extend(vocabulary.get_word_ids(chat['Message'].lower().split()))
+			
+			message_starts.append(len(word_ids))
+			
+			unix_timestamp = chat['UnixTimestamp']
+			min_unix_timestamp = unix_timestamp if min_unix_timestamp is None else min(min_unix_timestamp, unix_timestamp)
+			max_unix_timestamp = unix_timestamp if max_unix_timestamp is None else max(max_unix_timestamp, unix_timestamp)
+
+		db.execute('COMMIT;')
+	except sqlite3.Error:
+		if db.in_transaction:
+			db.execute('ROLLBACK;')
+		vocabulary.forget_all()
+		raise
+
+	directory_path = os.path.join(archive_path, twitch_id)
+	info_path = os.path.join(directory_path, 'archive.json')
+	
+	# The information file is removed first and written last so that a partially written archive is never used.
+	os.makedirs(directory_path, exist_ok=True)
+	if os.path.exists(info_path):
+		os.remove(info_path)
+
+	np.save(os.path.join(directory_path, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int32))
+	np.save(os.path.join(directory_path, 'word_ids.npy'), np.frombuffer(word_ids, dtype=np.uint32))
+	np.save(os.path.join(directory_path, 'message_starts.npy'), np.frombuffer(message_starts, dtype=np.uint64))
+
+	vocabulary_size = max(word_ids, default=-1) + 1
+	get_archive_vocabulary(archive_path).save(vocabulary, vocabulary_size)
+
+	info = {
+		'version': CHAT_ARCHIVE_VERSION,
+		'fingerprint': list(chat_fingerprint),
+		'num_messages': len(offsets),
+		'vocabulary_size': vocabulary_size,
+		'min_unix_timestamp': min_unix_timestamp,
+		'max_unix_timestamp': max_unix_timestamp,
+	}
+
+	temporary_info_path = info_path + '.tmp'
+	with open(temporary_info_path, 'w', encoding='utf-8') as file:
+		json.dump(info, file)
+	os.replace(temporary_info_path, info_path)
+
+	info['path'] = directory_path
+	info['archive_path'] = archive_path
+	return info
+
+# The categories matched by each word in a vocabulary, for each matcher in this process.
+vocabulary_masks: Dict[Tuple[Union[WordVocabulary, ArchiveVocabulary], Tuple[str, ...]], np.ndarray] = {}
+
+def get_vocabulary_masks(vocabulary: Union[WordVocabulary, ArchiveVocabulary], matcher: CategoryMatcher, size: int) -> np.ndarray:
+	""" Returns the categories matched by the first words in a vocabulary as a two-dimensional array with one row per word ID, where
+	each bit in the row's columns is one category. Only the words that weren't seen by previous calls are matched. """
+
+	key = (vocabulary, tuple(category.words_hash for category in matcher.categories))
+	masks = vocabulary_masks.get(key, np.zeros((0, (len(matcher.categories) + 63) // 64), dtype=np.uint64))
+
+	if len(masks) < size:
+
+		new_masks = np.zeros((size - len(masks), masks.shape[1]), dtype=np.uint64)
+		for i, word in enumerate(vocabulary.word_list[len(masks):size]):
+			if word is not None:
+				for category_index in matcher.match_token(word):
+					new_masks[i, category_index // 64] |= np.uint64(1 << (category_index % 64))
+		
+		masks = vocabulary_masks[key] = np.concatenate([masks, new_masks])
+
+	return masks[:size]
+
+def match_word_ids(vocabulary: Union[WordVocabulary, ArchiveVocabulary], matcher: CategoryMatcher, word_ids: np.ndarray, message_starts: np.ndarray, message_buckets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+	""" Returns the category index and bucket of every match in a list of messages, where each message is given by the position of its first
+	word ID and by its bucket. The categories of each word are only matched once, meaning no message is read as a string. """
+
+	masks = get_vocabulary_masks(vocabulary, matcher, int(word_ids.max()) + 1 if word_ids.size > 0 else 0)
+
+	# Combine the categories of each message's words. Messages without any words are skipped since reduceat() requires
+	# every segment to have at least one element.
+	has_words = message_starts[1:] > message_starts[:-1]
+	message_buckets = message_buckets[has_words]
+
+	category_index_list = []
+	bucket_list = []
+
+	if message_buckets.size > 0:
+		
+		message_masks = np.bitwise_or.reduceat(masks[word_ids], message_starts[:-1][has_words].astype(np.intp), axis=0)
+
+		for i in range(len(matcher.categories)):
+			is_match = (message_masks[:, i // 64] >> np.uint64(i % 64)) & np.uint64(1) == 1
+			bucket_list.append(message_buckets[is_match])
+			category_index_list.append(np.full(bucket_list[-1].size, i, dtype=np.int64))
+
+	category_indexes = np.concatenate(category_index_list) if category_index_list else np.zeros(0, dtype=np.int64)
+	buckets = np.concatenate(bucket_list) if bucket_list else np.zeros(0, dtype=np.int64)
+	return category_indexes, buckets
+
+def count_archived_chat_frequency(archive_info: dict, matcher: CategoryMatcher, num_buckets: int, bucket_length: int, unix_time_range: Optional[Tuple[int, int]]) -> np.ndarray:
+	""" Counts the number of messages per category and bucket in a VOD's chat archive, like count_chat_frequency(). The archive's
+	files are memory-mapped and only the words in the shared vocabulary file are matched, meaning the database isn't read. """
+
+	if unix_time_range is not None and archive_info['num_messages'] > 0:
+		begin_unix_time, end_unix_time = unix_time_range
+		assert begin_unix_time <= archive_info['min_unix_timestamp'] and archive_info['max_unix_timestamp'] <= end_unix_time, 'The chat message was not sent during the live stream.'
+
+	with profiler.stage('fetch chat'):
+		offsets = np.load(os.path.join(archive_info['path'], 'offsets.npy'), mmap_mode='r')
+		word_ids = np.load(os.path.join(archive_info['path'], 'word_ids.npy'), mmap_mode='r')
+		message_starts = np.load(os.path.join(archive_info['path'], 'message_starts.npy'), mmap_mode='r')
+		vocabulary = get_archive_vocabulary(archive_info['archive_path'], archive_info['vocabulary_size'])
+
+	with profiler.stage('match messages'):
+		message_buckets = np.floor_divide(offsets, bucket_length).astype(np.int64)
+		category_indexes, buckets = match_word_ids(vocabulary, matcher, word_ids, message_starts, message_buckets)
+
+	profiler.count('messages', archive_info['num_messages'])
+	profiler.count('tokens', word_ids.size)
+	profiler.count('matches', buckets.size)
+
+	with profiler.stage('count buckets'):
+		return count_frequency(category_indexes, buckets, len(matcher.categories), num_buckets)
+
+def is_searchable_category(category: Category) -> bool:
+	""" Checks if every message that matches a category can be found using the chat search index. This is only true for categories
+	without regular expressions whose words are ASCII strings that contain at least one indexed character. """
+
+	return bool(category.search_words) and all(isinstance(word, str) and word.isascii() and any(char.isalnum() or char in CHAT_SEARCH_TOKEN_CHARS for char in word)
+											   for word in category.search_words)
+
+def count_category_frequency(db: sqlite3.Connection, get_matcher: Callable[[List[Category]], CategoryMatcher], categories: List[Category], video_id: int, num_buckets: int, bucket_length: int, unix_time_range: Optional[Tuple[int, int]], use_search_index: bool, archive_info: Optional[dict] = None) -> np.ndarray:
+	""" Counts the number of messages per category (rows, in the same order as the list) and bucket (columns) in a VOD's chat. If the
+	VOD's chat archive is given, every category is counted using it instead of the database. Otherwise, if the chat search index is used,
+	only the categories that can't be searched require reading every message. """
+
+	if archive_info is not None:
+		return count_archived_chat_frequency(archive_info, get_matcher(categories), num_buckets, bucket_length, unix_time_range)
+
+	searchable_categories = [category for category in categories if is_searchable_category(category)] if use_search_index else []
+	scanned_categories = [category for category in categories if category not in searchable_categories]
+
+	frequency = np.zeros((len(categories), num_buckets), dtype=np.int64)
+
+	if scanned_categories:
+		rows = [categories.index(category) for category in scanned_categories]
+		frequency[rows] = count_chat_frequency(db, get_matcher(scanned_categories), video_id, num_buckets, bucket_length, unix_time_range)
+
+	if searchable_categories:
+		
+		# Each word is searched as a quoted string, meaning it's split into the same words as the indexed messages.
+		search_query = ' OR '.join('"' + word.replace('"', '""') + '"' for category in searchable_categories for word in category.search_words)
+		
+		rows = [categories.index(category) for category in searchable_categories]
+		frequency[rows] = count_chat_frequency(db, get_matcher(searchable_categories), video_id, num_buckets, bucket_length, unix_time_range, search_query)
+
+	return frequency
+
+# The fields of a video in the Twitch API that are used to find new VODs. The creation time uses the format 2000-01-01T00:00:00Z.
+ListedVideo = namedtuple('ListedVideo', ['id', 'title', 'created_at', 'duration'])
+
+class HelixVideoSource():
+	""" Lists a channel's videos using the Twitch API. """
+
+	helix: Helix
+
+	def __init__(self, client_id: str, access_token: str):
+		self.helix = Helix(client_id, bearer_token=access_token, use_cache=True)
+
+	def list_videos(self, channel_name: str, vod_type: str) -> Iterator[ListedVideo]:
+		""" Yields every video of a given type from newest to oldest. """
+		for video in self.helix.user(channel_name).videos(type=vod_type):
+			yield ListedVideo(video.id, video.title, video.created_at, video.duration)
+
+	def get_status(self) -> str:
+		return f'The remaining API rate limit is {self.helix.api.rate_limit_remaining} of {self.helix.api.rate_limit_points} points.'
+
+class JsonVideoSource():
+	""" Lists a channel's videos from a JSON file instead of the Twitch API (e.g. to test the script without network access). The file
+	contains a list of videos with the same fields as the API, or an object with this list in its "data" key. """
+
+	video_list: List[dict]
+
+	def __init__(self, file_path: str):
+		with open(file_path, encoding='utf-8') as file:
+			data = json.load(file)
+		self.video_list = data['data'] if isinstance(data, dict) else data
+
+	def list_videos(self, channel_name: str, vod_type: str) -> Iterator[ListedVideo]:
+		""" Yields every video of a given type from newest to oldest. Any fields that identify the channel or type are optional. """
+
+		for video in sorted(self.video_list, key=lambda x: x['created_at'], reverse=True):
+
+			if video.get('user_login', channel_name).lower() != channel_name or vod_type not in ['all', video.get('type', vod_type)]:
+				continue
+
+			yield ListedVideo(str(video['id']), video['title'], video['created_at'], video['duration'])
+
+	def get_status(self) -> str:
+		return f'Read {len(self.video_list)} videos from the JSON file.'
+
+def list_videos(db: sqlite3.Connection, source: Union[HelixVideoSource, JsonVideoSource], channel_id: int, channel_name: str, vod_type: str, begin_date: str, use_cache: bool) -> Tuple[List[ListedVideo], int]:
+	""" Returns a channel's videos of a given type that were created on or after a date, from newest to oldest, and the number of videos
+	that were read from the source. If the cache is used, only the videos that are newer than the last ones seen are read, unless the
+	date is earlier than the one used by any previous run. """
+
+	listing = None
+	if use_cache:
+		cursor = db.execute('SELECT BeginDate, NewestCreatedAt FROM VideoListing WHERE ChannelId = :channel_id AND VodType = :vod_type;', {'channel_id': channel_id, 'vod_type': vod_type})
+		listing = cursor.fetchone()
+
+	is_incremental = listing is not None and listing['BeginDate'] <= begin_date
+	newest_created_at = listing['NewestCreatedAt'] if listing is not None else None
+	
+	# The newest video that was previously seen is read again since its duration may have changed if it was still live.
+	# Videos are listed from newest to oldest, so we can stop after reaching it.
+	source_video_list = []
+	for video in source.list_videos(channel_name, vod_type):
+
+		creation_date, _ = video.created_at.split('T', 1)
+
+		if creation_date < begin_date or (is_incremental and newest_created_at is not None and video.created_at < newest_created_at):
+			break
+
+		source_video_list.append(video)
+
+	if not use_cache:
+		return source_video_list, len(source_video_list)
+
+	db.execute('BEGIN;')
+
+	try:
+		db.executemany(	'''
+						INSERT OR REPLACE INTO ListedVideo (ChannelId, VodType, TwitchId, Title, CreatedAt, Duration)
+						VALUES (:channel_id, :vod_type, :twitch_id, :title, :created_at, :duration);
+						''',
+						({'channel_id': channel_id, 'vod_type': vod_type, 'twitch_id': video.id, 'title': video.title, 'created_at': video.created_at, 'duration': video.duration} for video in source_video_list))
+
+		newest_created_at = max([video.created_at for video in source_video_list] + ([newest_created_at] if newest_created_at is not None else []), default=None)
+
+		db.execute(	'''
+					INSERT OR REPLACE INTO VideoListing (ChannelId, VodType, BeginDate, NewestCreatedAt, UpdateTime)
+					VALUES (:channel_id, :vod_type, :begin_date, :newest_created_at, :update_time);
+					''',
+					{'channel_id': channel_id, 'vod_type': vod_type, 'begin_date': listing['BeginDate'] if is_incremental else begin_date,
+					 'newest_created_at': newest_created_at, 'update_time': datetime.now(tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')})
+
+		db.execute('COMMIT;')
+
+	except sqlite3.Error:
+		if db.in_transaction:
+			db.execute('ROLLBACK;')
+		raise
+
+	cursor = db.execute('''
+						SELECT TwitchId, Title, CreatedAt, Duration FROM ListedVideo
+						WHERE ChannelId = :channel_id AND VodType = :vod_type AND CreatedAt >= :begin_date
+						ORDER BY CreatedAt DESC;
+						''',
+						{'channel_id': channel_id, 'vod_type': vod_type, 'begin_date': begin_date})
+	
+	return [ListedVideo(*row) for row in cursor], len(source_video_list)
+
+def reassign_chat(db: sqlite3.Connection, channel_id: int, video_ranges: List[dict], chat_shard_path: Optional[str]) -> Tuple[int, int]:
+	""" Assigns the chat messages in a channel to the VODs whose time ranges contain them in a single transaction. Each range is a dictionary
+	with the VOD's database ID, its Unix creation and end times, and its begin and end timestamps. Returns the number of messages that were
+	assigned to a VOD and the number that were removed from a VOD since they were outside its time range. The messages in the main
+	database and in the chat shards that overlap the VODs are updated. These shards are attached before the transaction begins, and if
+	there are more than SQLite can attach at once, the VODs are split into groups that are each updated in their own transaction. """
+
+	# Each group has consecutive VODs whose shards can be attached together. Without any shards, every VOD is in the same group.
+	group_list: List[Tuple[List[str], List[dict]]] = []
+	max_attached = db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+
+	for video_range in sorted(video_ranges, key=lambda x: x['begin_time']):
+		
+		shard_names = find_chat_shards(db, [(video_range['unix_creation_time'], video_range['unix_end_time'])]) if chat_shard_path is not None else []
+		
+		if group_list:
+			group_shard_names, group_ranges = group_list[-1]
+			merged_shard_names = sorted(set(group_shard_names) | set(shard_names))
+			
+			if len(merged_shard_names) <= max_attached:
+				group_list[-1] = (merged_shard_names, group_ranges + [video_range])
+				continue
+
+		group_list.append((shard_names, [video_range]))
+
+	def update_chat(shard_names: List[str], unassign_ranges: List[dict], assign_ranges: List[dict]) -> Tuple[int, int]:
+		
+		if chat_shard_path is not None:
+			attach_chat_shards(db, chat_shard_path, shard_names)
+
+		schema_list = ['main'] + shard_names
+		changed_video_ids = set()
+		num_assigned = 0
+		num_unassigned = 0
+
+		db.execute('BEGIN;')
+
+		try:
+			# Remove any messages outside each VOD's time range first (e.g. after fixing a wrong duration), so that they can be assigned
+			# to the right VOD below. Each side of the range is a separate query so that only those messages are read from the index.
+			for video_range in unassign_ranges:
+				for schema, condition in product(schema_list, ['Timestamp < :begin_time', 'Timestamp > :end_time']):
+					cursor = db.execute(f'UPDATE {schema}.Chat SET VideoId = NULL, VideoOffset = NULL WHERE VideoId = :video_id AND {condition};', video_range)
+					if cursor.rowcount > 0:
+						num_unassigned += cursor.rowcount
+						changed_video_ids.add(video_range['video_id'])
+
+			# If the VODs overlap, the messages go to the one that was created first. These queries only read the messages that aren't
+			# assigned to a VOD, meaning they do almost nothing when the chat was already assigned by a previous run.
+			for video_range, schema in product(assign_ranges, schema_list):
+				cursor = db.execute(f'''
+									UPDATE {schema}.Chat SET VideoId = :video_id, VideoOffset = UnixTimestamp - :unix_creation_time
+									WHERE VideoId IS NULL AND ChannelId = :channel_id AND Timestamp BETWEEN :begin_time AND :end_time;
+									''',
+									{'channel_id': channel_id, **video_range})
+				
+				if cursor.rowcount > 0:
+					num_assigned += cursor.rowcount
+					changed_video_ids.add(video_range['video_id'])
+
+			# Any message counts from previous runs are no longer valid.
+			db.executemany('DELETE FROM FrequencyCache WHERE VideoId = ?;', [(video_id,) for video_id in sorted(changed_video_ids)])
+
+			db.execute('COMMIT;')
+
+		except sqlite3.Error:
+			if db.in_transaction:
+				db.execute('ROLLBACK;')
+			raise
+
+		return num_assigned, num_unassigned
+
+	if len(group_list) == 1:
+		shard_names, group_ranges = group_list[0]
+		return update_chat(shard_names, group_ranges, group_ranges)
+
+	# Otherwise, the messages are removed from every group before they're assigned to any of them, so that the messages that move
+	# between groups still go to the right VOD.
+	num_assigned = 0
+	num_unassigned = 0
+
+	for shard_names, group_ranges in group_list:
+		num_unassigned += update_chat(shard_names, group_ranges, [])[1]
+
+	for shard_names, group_ranges in group_list:
+		num_assigned += update_chat(shard_names, [], group_ranges)[0]
+
+	return num_assigned, num_unassigned
+
+def select_top_candidates(candidate_list: list, sort_key: Callable[[Any], Any], reverse: bool, top: int, distance_threshold: Optional[int]) -> Tuple[list, int]:
+	""" Returns the best ranked highlight candidates in order, and the number of candidates that were skipped. Candidates with the same
+	rank keep their original order. If a distance threshold is given, a candidate is skipped when it's fewer than that many buckets away
+	from any better ranked candidate in the same VOD, even if the latter was also skipped. """
+
+	sign = -1 if reverse else 1
+	heap = [(sign * sort_key(candidate), i) for i, candidate in enumerate(candidate_list)]
+	heapq.heapify(heap)
+
+	selected_list: list = []
+	num_skipped = 0
+
+	# The sorted buckets of every candidate that was already ranked in each VOD.
+	ranked_buckets: Dict[int, List[int]] = {}
+
+	while heap and len(selected_list) < top:
+
+		_, i = heapq.heappop(heap)
+		candidate = candidate_list[i]
+
+		if distance_threshold is not None:
+			
+			# Only the closest ranked buckets on either side have to be checked.
+			bucket_list = ranked_buckets.setdefault(candidate.Video.Id, [])
+			position = bisect_left(bucket_list, candidate.Bucket)
+			
+			is_too_close = (position > 0 and candidate.Bucket - bucket_list[position - 1] < distance_threshold) \
+						or (position < len(bucket_list) and bucket_list[position] - candidate.Bucket < distance_threshold)
+			
+			bucket_list.insert(position, candidate.Bucket)
+
+			if is_too_close:
+				num_skipped += 1
+				continue
+
+		selected_list.append(candidate)
+
+	return selected_list, num_skipped
+
+# Increment this whenever the plots change in a way that isn't captured by their fingerprint (see compute_plot_fingerprint).
+PLOT_VERSION = 1
+
+def compute_plot_fingerprint(plot: dict) -> str:
+	""" Returns a hash of everything that is drawn in a plot, including the message counts of each category. """
+
+	plot_hash = hashlib.sha256()
+	plot_options = {key: value for key, value in plot.items() if key != 'series'}
+	plot_hash.update(json.dumps([PLOT_VERSION, plot_options, [(label, color) for label, color, _ in plot['series']]], sort_keys=True).encode())
+	
+	for _, _, y_data in plot['series']:
+		plot_hash.update(y_data.astype('<i8').tobytes())
+
+	return plot_hash.hexdigest()
+
+def read_plot_fingerprint(plot_filename: str) -> Optional[str]:
+	""" Returns the fingerprint saved in a PNG file's text metadata, or None if the file or fingerprint don't exist. """
+
+	try:
+		with open(plot_filename, 'rb') as file:
+			
+			if file.read(8) != b'\x89PNG\r\n\x1a\n':
+				return None
+
+			# Each chunk has a length, a type, its data, and a CRC. The text chunks are written before the image data.
+			while True:
+				chunk_header = file.read(8)
+				if len(chunk_header) < 8:
+					return None
+				
+				length, chunk_type = struct.unpack('>I4s', chunk_header)
+				if chunk_type == b'IDAT' or chunk_type == b'IEND':
+					return None
+				elif chunk_type == b'tEXt':
+					keyword, _, text = file.read(length).partition(b'\0')
+					if keyword == b'Fingerprint':
+						return text.decode('latin-1')
+					file.seek(4, os.SEEK_CUR)
+				else:
+					file.seek(length + 4, os.SEEK_CUR)
+	
+	except (OSError, struct.error):
+		return None
+
+def render_plot(plot_filename: str, plot: dict, fingerprint: str) -> None:
+	""" Draws the number of messages in each category during a VOD and saves it to a PNG file along with its fingerprint. """
+
+	figure, axes = plt.subplots(figsize=(12, 6))
+
+	max_messages = 0
+	for label, color, y_data in plot['series']:
+
+		x_data = np.arange(len(y_data)) * plot['bucket_length']
+		axes.plot(x_data, y_data, label=label, color=color, linewidth=0.7)
+
+		max_messages = max(max_messages, int(y_data.max(initial=0)))
+
+	if plot['message_threshold'] is not None:
+		axes.axhline(y=plot['message_threshold'], label=f'Threshold ({plot["message_threshold"]})', color='k', linestyle='dashed')
+
+	axes.set(xlabel=f'Time in Buckets of {plot["bucket_length"]} Seconds', ylabel='Number of Messages', title=plot['title'])
+	axes.legend()
+	
+	# Format the number of seconds as 00h00.
+	def seconds_formatter(num_seconds, position):
+		label, _ = str(timedelta(seconds=num_seconds)).rsplit(':', 1)
+		return label.replace(':', 'h', 1)
+
+	axes.xaxis.set_major_formatter(seconds_formatter)
+	axes.xaxis.set_major_locator(MultipleLocator(30*60 if plot['duration_in_seconds'] >= 90*60 else 15*60))
+	axes.xaxis.set_minor_locator(AutoMinorLocator(4))
+	
+	axes.yaxis.set_major_locator(MultipleLocator(5 if max_messages <= 100 else 10))
+
+	axes.tick_params(axis='x', which='major', length=7)
+	axes.tick_params(axis='x', which='minor', length=4)
+
+	axes.set_ylim(-2)
+
+	figure.tight_layout()
+
+	# Write to a temporary file first so that an interrupted run never leaves behind a partial image with a valid fingerprint.
+	temporary_filename = plot_filename + '.tmp'
+	figure.savefig(temporary_filename, format='png', dpi=200, metadata={'Fingerprint': fingerprint})
+	plt.close(figure)
+	
+	os.replace(temporary_filename, plot_filename)
+
+# The compiled categories of each process. Channels and VODs that count the same words share the same matcher.
+matcher_cache: Dict[Tuple[str, ...], CategoryMatcher] = {}
+
+def get_matcher(categories: List[Category]) -> CategoryMatcher:
+	
+	key = tuple(category.words_hash for category in categories)
+	if key not in matcher_cache:
+		matcher_cache[key] = CategoryMatcher(categories)
+
+	return matcher_cache[key]
+
+# The read-only database connection of each worker process when using multiple jobs.
+worker_db: Optional[sqlite3.Connection] = None
+worker_chat_shard_path: Optional[str] = None
+
+def init_frequency_worker(database_path: str, chat_shard_path: Optional[str], enable_profiler: bool) -> None:
+
+	global worker_db, worker_chat_shard_path
+	worker_db = sqlite3.connect(Path(database_path).as_uri() + '?mode=ro', uri=True)
+	worker_db.row_factory = sqlite3.Row
+	worker_chat_shard_path = chat_shard_path
+
+	profiler.enabled = enable_profiler
+
+def count_category_frequency_in_worker(shard_names: List[str], categories: List[Category], video_id: int, num_buckets: int, bucket_length: int, unix_time_range: Optional[Tuple[int, int]], use_search_index: bool, archive_info: Optional[dict]) -> Tuple[Optional[np.ndarray], Optional[str], dict]:
+	""" Counts the messages in a VOD's chat in a worker process, after attaching the chat shards that overlap it. Returns the frequency
+	array or the error that prevented it from being counted, along with the worker's profiler snapshot. """
+
+	try:
+		attach_chat_shards(worker_db, worker_chat_shard_path, shard_names, read_only=True)
+		frequency, error_text = count_category_frequency(worker_db, get_matcher, categories, video_id, num_buckets, bucket_length, unix_time_range, use_search_index, archive_info), None
+	except (sqlite3.Error, OSError, ValueError) as error:
+		frequency, error_text = None, repr(error)
+
+	return frequency, error_text, profiler.take_snapshot()
+
+class ProcessPools():
+	""" The process pools that count the chat messages and render the plots. These are only created when they're first needed, and are
+	shared by every channel when generating the highlights for more than one. """
+
+	jobs: int
+	database_path: str
+	chat_shard_path: Optional[str]
+	
+	frequency_executor: Optional[ProcessPoolExecutor]
+	plot_executor: Optional[ProcessPoolExecutor]
+
+	def __init__(self, jobs: int, database_path: str, chat_shard_path: Optional[str]):
+		self.jobs = jobs
+		self.database_path = database_path
+		self.chat_shard_path = chat_shard_path
+		self.frequency_executor = None
+		self.plot_executor = None
+
+	def get_frequency_executor(self) -> ProcessPoolExecutor:
+		if self.frequency_executor is None:
+			self.frequency_executor = ProcessPoolExecutor(max_workers=self.jobs, initializer=init_frequency_worker, initargs=(self.database_path, self.chat_shard_path, profiler.enabled))
+		return self.frequency_executor
+
+	def get_plot_executor(self) -> ProcessPoolExecutor:
+		if self.plot_executor is None:
+			self.plot_executor = ProcessPoolExecutor(max_workers=self.jobs)
+		return self.plot_executor
+
+	def shutdown(self) -> None:
+		for executor in [self.frequency_executor, self.plot_executor]:
+			if executor is not None:
+				executor.shutdown()
+
 class HighlightConfig(CommonConfig):
 
 	# From the config file.
 	channel_name: str
+	channels: List[Union[str, dict]]
 	
 	vod_criteria: str
 	begin_date: str
@@ -88,6 +914,8 @@ class HighlightConfig(CommonConfig):
 
 	get_vods_from_api: bool
 	vod_type: str
+	cache_vod_listing: bool
+	vod_listing_path: Optional[str]
 	use_youtube_urls: bool
 
 	bucket_length: int
@@ -99,6 +927,9 @@ class HighlightConfig(CommonConfig):
 	plot_threshold: bool
 	show_word_list: bool
 
+	cache_frequency: bool
+	chat_archive_path: Optional[str]
+
 	categories: List['Category']
 	comparisons: List['CategoryComparison']
 
@@ -111,19 +942,50 @@ class HighlightConfig(CommonConfig):
 	vods_end_date: str
 	vods_begin_time: str
 	vods_end_time: str
+	vods_begin_unix_time: int
+	vods_end_unix_time: int
 	
 	vods_criteria_text: str
 	vods_criteria_summary_title: str
 	vods_criteria_filename_suffix: str
 
-	def __init__(self):
+	def __init__(self, channel_params: Union[str, dict, None] = None):
+		""" Loads the highlight options. If the parameters of a channel in the "channels" list are given, these override the same options
+		in the config file, except for categories which replace any others with the same name. """
 		
 		super().__init__()
 
+		self.channel_name = ''
+		self.channels = []
 		self.categories = []
 		self.comparisons = []
+		self.cache_frequency = True
+		self.chat_archive_path = None
+		self.cache_vod_listing = True
+		self.vod_listing_path = None
+
+		highlight_params = dict(self.json_config['highlight'])
+
+		if channel_params is not None:
+			
+			if isinstance(channel_params, str):
+				channel_params = {'channel_name': channel_params}
+
+			for key, value in channel_params.items():
+				if key == 'categories':
+					category_list = list(highlight_params.get('categories', []))
+					for category_params in value:
+						# Replace the category with the same name, or add it to the end of the list.
+						i = next((i for i, params in enumerate(category_list) if params['name'] == category_params['name']), len(category_list))
+						category_list[i:i+1] = [category_params]
+					highlight_params['categories'] = category_list
+				else:
+					highlight_params[key] = value
+			
+			# Each channel is generated separately.
+			highlight_params.pop('channels', None)
 
-		for key, value in self.json_config['highlight'].items():
+		for key, value in highlight_params.items():
 
 			if key == 'categories':
 				for category_params in value:
@@ -136,6 +998,10 @@ class HighlightConfig(CommonConfig):
 			else:
 				setattr(self, key, value)
 
+		# Each category is a row in the frequency array of every VOD.
+		for i, category in enumerate(self.categories):
+			category.frequency_index = i
+
 		self.channel_name = self.channel_name.lower()
 
 		# Exclude the last day from the date range since it includes midnight.
@@ -150,6 +1016,8 @@ class HighlightConfig(CommonConfig):
 		self.vods_end_date = self.vods_end_datetime.strftime('%Y-%m-%d')
 		self.vods_begin_time = self.vods_begin_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')
 		self.vods_end_time = self.vods_end_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')
+		self.vods_begin_unix_time = convert_datetime_to_unix_time(self.vods_begin_datetime)
+		self.vods_end_unix_time = convert_datetime_to_unix_time(self.vods_end_datetime)
 
 		if self.vod_criteria == 'date':
 			self.vods_criteria_text = f'between {self.vods_begin_date} and {self.vods_end_date}'
@@ -169,33 +1037,19 @@ class HighlightConfig(CommonConfig):
 			comparison.positive_category = next(category for category in self.categories if category.name == comparison.positive_category)
 			comparison.negative_category = next(category for category in self.categories if category.name == comparison.negative_category)
 
-if __name__ == '__main__':
-
-	parser = ArgumentParser(description='Processes any saved chat messages in the database between two dates, generates a summary text file with the top highlights in different categories, and optionally creates images that plot chat\'s reactions during each live stream.')
-	args = parser.parse_args()
-
-	# Read the configurations file, connect to the database, and setup the Twitch API for a given channel.
-
-	config = HighlightConfig()
-
-	try:
-		db = config.connect_to_database()
-		print(f'Connected to the database: {config.database_path}')
-	except sqlite3.Error as error:
-		print(f'Failed to connect to the database with the error: {repr(error)}')
-		sys.exit(1)
+def generate_highlights(config: HighlightConfig, db: sqlite3.Connection, id_cache: DatabaseIdCache, pools: ProcessPools, video_sources: dict) -> bool:
+	""" Generates the summary and plots for a channel. Returns false if they couldn't be generated. """
 
 	try:
-		cursor = db.execute('SELECT Id FROM Channel WHERE Name = :name;', {'name': config.channel_name})
-		row = cursor.fetchone()
-		if row:
-			config.channel_database_id = row['Id']
+		channel_id = id_cache.get_channel_id(config.channel_name)
+		if channel_id is not None:
+			config.channel_database_id = channel_id
 		else:
 			print(f'Could not find the channel "{config.channel_name}" in the database.')
-			sys.exit(1)
+			return False
 	except sqlite3.Error as error:
 		print(f'Failed to get the ID for the channel "{config.channel_name}" with the error: {repr(error)}')
-		sys.exit(1)
+		return False
 
 	print()
 
@@ -206,24 +1060,41 @@ if __name__ == '__main__':
 
 		if config.vod_criteria != 'date':
 			print(f'Cannot find new VODs via the Twitch API while using the "{config.vod_criteria}" criteria. Only "date" is allowed.')
-			sys.exit(1)
-
-		helix = Helix(config.client_id, bearer_token=config.access_token, use_cache=True)
-		helix_user = helix.user(config.channel_name)
-		helix_video_list = []
+			return False
+
+		# The same source is used for every channel (e.g. to share the API's rate limit).
+		video_source = video_sources.get(config.vod_listing_path)
+		if video_source is None:
+			if config.vod_listing_path is not None:
+				try:
+					video_source = JsonVideoSource(config.vod_listing_path)
+				except (OSError, ValueError, KeyError) as error:
+					print(f'Could not read the videos from "{config.vod_listing_path}" with the error: {repr(error)}')
+					return False
+			else:
+				video_source = HelixVideoSource(config.client_id, config.access_token)
+			
+			video_sources[config.vod_listing_path] = video_source
 
 		# Search the videos section (past broadcasts, highlights, uploads, or all).
-		for video in helix_user.videos(type=config.vod_type):
+		try:
+			with profiler.stage('list vods'):
+				listed_video_list, num_source_videos = list_videos(db, video_source, config.channel_database_id, config.channel_name, config.vod_type, config.vods_begin_date, config.cache_vod_listing)
+		except sqlite3.Error as error:
+			print(f'Could not update the cached videos with the error: {repr(error)}')
+			return False
 
+		helix_video_list = []
+		for video in listed_video_list:
+			
 			# Creation date format: 2000-01-01T00:00:00Z
 			creation_date, _ = video.created_at.split('T', 1)
 
-			if creation_date < config.vods_begin_date:
-				break
-			elif config.vods_begin_date <= creation_date <= config.vods_end_date:
+			if config.vods_begin_date <= creation_date <= config.vods_end_date:
 				helix_video_list.append(video)
 
 		helix_video_list = sorted(helix_video_list, key=lambda x: x.created_at)
+		video_ranges = []
 
 		for video in helix_video_list:
 
@@ -235,17 +1106,20 @@ if __name__ == '__main__':
 			
 			creation_time = creation_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')
 			end_time = end_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')
+			unix_creation_time = convert_datetime_to_unix_time(creation_datetime)
 
 			try:
 				db.execute(	'''
-							INSERT OR IGNORE INTO Video (ChannelId, TwitchId, Title, CreationTime, Duration)
-							VALUES (:channel_id, :twitch_id, :title, :creation_time, :duration);
+							INSERT OR IGNORE INTO Video (ChannelId, TwitchId, Title, CreationTime, UnixCreationTime, Duration)
+							VALUES (:channel_id, :twitch_id, :title, :creation_time, :unix_creation_time, :duration);
 							''',
-							{'channel_id': config.channel_database_id, 'twitch_id': video.id, 'title': video.title, 'creation_time': creation_time, 'duration': duration})
+							{'channel_id': config.channel_database_id, 'twitch_id': video.id, 'title': video.title, 'creation_time': creation_time, 'unix_creation_time': unix_creation_time, 'duration': duration})
 
 			except sqlite3.Error as error:
 				print(f'Could not insert the video {video.id} ({video.title}) with the error: {repr(error)}')
 
+			id_cache.forget_video(video.id)
+
 			# Sometimes Twitch errors can temporarily break the video's length and return longer duration (e.g. over 24 hours).
 			# We'll query the duration again since that allows us to fix any wrong durations by editing the corresponding
 			# column in the database. Since the previous query ignores duplicate VODs we won't overwrite our fix.
@@ -253,35 +1127,33 @@ if __name__ == '__main__':
 			# is over 24 hours, then it might bleed into the next VOD).
 
 			try:		
-				cursor = db.execute('SELECT Duration FROM Video WHERE TwitchId = :twitch_id;', {'twitch_id': video.id})
+				video_id = id_cache.get_video_id(video.id)
+				cursor = db.execute('SELECT Duration, UnixCreationTime FROM Video WHERE Id = :video_id;', {'video_id': video_id})
 				row = cursor.fetchone()
 				duration = row['Duration']
+				unix_creation_time = row['UnixCreationTime']
 
-				hours, minutes, seconds, _ = split_twitch_duration(duration)
+				hours, minutes, seconds, duration_in_seconds = split_twitch_duration(duration)
 				end_datetime = creation_datetime + timedelta(hours=hours, minutes=minutes, seconds=seconds)
 				end_time = end_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')
 
+				video_ranges.append({'video_id': video_id, 'unix_creation_time': unix_creation_time, 'unix_end_time': unix_creation_time + duration_in_seconds * 1_000_000,
+									 'begin_time': creation_time, 'end_time': end_time})
+
 			except sqlite3.Error as error:
 				print(f'Could not retrieve the duration for the video {video.id} ({video.title}) with the error: {repr(error)}')
 
-			try:
-				db.execute(	'''
-							UPDATE Chat SET VideoId = NULL
-							WHERE VideoId = (SELECT Id FROM Video WHERE TwitchId = :twitch_id) AND Timestamp NOT BETWEEN :begin_time AND :end_time;
-							''',
-							{'twitch_id': video.id, 'begin_time': creation_time, 'end_time': end_time})
-
-				db.execute(	'''
-							UPDATE Chat SET VideoId = (SELECT Id FROM Video WHERE TwitchId = :twitch_id)
-							WHERE VideoId IS NULL AND ChannelId = :channel_id AND Timestamp BETWEEN :begin_time AND :end_time;
-							''',
-							{'twitch_id': video.id, 'channel_id': config.channel_database_id, 'begin_time': creation_time, 'end_time': end_time})
-
-			except sqlite3.Error as error:
-				print(f'Could not update the chat for the video {video.id} ({video.title}) with the error: {repr(error)}')
+		try:
+			with profiler.stage('assign chat'):
+				num_assigned, num_unassigned = reassign_chat(db, config.channel_database_id, video_ranges, config.chat_shard_path)
+			
+			print(f'Assigned {num_assigned} chat messages to their VODs and removed {num_unassigned} messages from VODs whose time range doesn\'t include them.')
+		
+		except (sqlite3.Error, OSError) as error:
+			print(f'Could not update the chat for the videos with the error: {repr(error)}')
 
 		print(f'Found {len(helix_video_list)} videos in the "{config.vod_type}" section of the "{config.channel_name}" channel using the API.')
-		print(f'The remaining API rate limit is {helix.api.rate_limit_remaining} of {helix.api.rate_limit_points} points.')
+		print(f'Requested {num_source_videos} new or updated videos while the rest were cached in the database. {video_source.get_status()}')
 		print()
 
 	# Iterate over each VOD and its chat for the requested time period. For each VOD, we'll count the
@@ -296,6 +1168,7 @@ if __name__ == '__main__':
 		TwitchId: str
 		Title: str
 		CreationTime: str
+		UnixCreationTime: int
 		Duration: str
 		YouTubeId: str
 		Notes: str
@@ -306,7 +1179,8 @@ if __name__ == '__main__':
 		
 		DurationInSeconds: int
 		NumBuckets: int
-		Frequency: dict
+		Frequency: np.ndarray
+		ComparisonFrequency: Dict[str, np.ndarray]
 		
 		HostId: str
 		Url: str
@@ -325,9 +1199,9 @@ if __name__ == '__main__':
 			self.DurationInSeconds = duration_in_seconds
 			self.NumBuckets = ceil(duration_in_seconds / config.bucket_length)
 
-			self.Frequency = {}
-			for category in config.categories:
-				self.Frequency[category.name] = [0] * self.NumBuckets
+			# The number of messages in each category (rows) and bucket (columns).
+			self.Frequency = np.zeros((len(config.categories), self.NumBuckets), dtype=np.int64)
+			self.ComparisonFrequency = {}
 
 			if config.use_youtube_urls and self.YouTubeId is not None:
 				self.HostId = self.YouTubeId
@@ -349,111 +1223,213 @@ if __name__ == '__main__':
 		video_list = [Video(**dict(row)) for row in cursor]
 	except sqlite3.Error as error:
 		print(f'Failed to retrieve the videos {config.vods_criteria_text} with the error: {repr(error)}')
-		sys.exit(1)
+		return False
 
 	if not video_list:
 		print(f'Could not find any videos in the "{config.channel_name}" channel {config.vods_criteria_text}.')
-		sys.exit(1)
+		return False
 
 	print(f'Found {len(video_list)} videos in the "{config.channel_name}" channel {config.vods_criteria_text}.')
 
+	# Each VOD's chat is read from the main database and from the chat shards that overlap it (at most two monthly shards), meaning
+	# the rest are never attached. These are attached one VOD at a time since SQLite can only attach a few databases at once.
+	shard_names_list: List[List[str]] = [[] for _ in video_list]
+
+	if config.chat_shard_path is not None:
+		try:
+			shard_names_list = [find_chat_shards(db, [(video.UnixCreationTime, video.UnixCreationTime + video.DurationInSeconds * 1_000_000)]) for video in video_list]
+		except sqlite3.Error as error:
+			print(f'Could not find the chat shards for the videos with the error: {repr(error)}')
+			return False
+
+	def attach_video_chat_shards(i: int) -> None:
+		if config.chat_shard_path is not None:
+			attach_chat_shards(db, config.chat_shard_path, shard_names_list[i])
+
+	# The chat search index only contains the messages in the main database, so it's only used for VODs without any shards.
+	use_search_index_list = [config.chat_search_index and not shard_names for shard_names in shard_names_list]
+
+	def get_chat_fingerprint(video: Video) -> Tuple[int, int]:
+		""" Returns the number of messages in a VOD's chat and their maximum ID. This changes whenever messages are added or removed. """
+		row = db.execute('SELECT COUNT(*), MAX(Id) FROM AllChat WHERE VideoId = :video_id;', {'video_id': video.Id}).fetchone()
+		compacted_row = db.execute('SELECT NumMessages, MaxId FROM CompactedChat WHERE VideoId = :video_id;', {'video_id': video.Id}).fetchone()
+		
+		if compacted_row is not None:
+			return row[0] + compacted_row[0], max(row[1] or 0, compacted_row[1])
+		
+		return row[0], row[1] or 0
+
+	def load_cached_frequency(video: Video, chat_fingerprint: Tuple[int, int]) -> List[Category]:
+		""" Loads any valid cached message counts into a VOD's frequency array and returns the categories that still have to be counted. """
+
+		cursor = db.execute('SELECT * FROM FrequencyCache WHERE VideoId = :video_id AND BucketLength = :bucket_length;', {'video_id': video.Id, 'bucket_length': config.bucket_length})
+		cached_rows = {row['WordsHash']: row for row in cursor}
+
+		missing_categories = []
+		for category in config.categories:
+			
+			row = cached_rows.get(category.words_hash)
+			if row is not None and row['NumBuckets'] == video.NumBuckets and (row['ChatCount'], row['ChatMaxId']) == chat_fingerprint:
+				video.Frequency[category.frequency_index] = np.frombuffer(row['Counts'], dtype='<i8')
+			else:
+				missing_categories.append(category)
+
+		return missing_categories
+
+	def save_cached_frequency(video: Video, chat_fingerprint: Tuple[int, int], category_list: List[Category]) -> None:
+
+		chat_count, chat_max_id = chat_fingerprint
+
+		db.execute('BEGIN;')
+		db.executemany(	'''
+						INSERT OR REPLACE INTO FrequencyCache (VideoId, BucketLength, WordsHash, NumBuckets, ChatCount, ChatMaxId, Counts)
+						VALUES (:video_id, :bucket_length, :words_hash, :num_buckets, :chat_count, :chat_max_id, :counts);
+						''',
+						[{'video_id': video.Id, 'bucket_length': config.bucket_length, 'words_hash': category.words_hash, 'num_buckets': video.NumBuckets,
+						  'chat_count': chat_count, 'chat_max_id': chat_max_id, 'counts': video.Frequency[category.frequency_index].astype('<i8').tobytes()}
+						  for category in category_list])
+		db.execute('COMMIT;')
+
+	# Past VODs rarely change, so we'll reuse the message counts from previous runs whenever possible.
+	missing_categories_list: List[List[Category]] = []
+	chat_fingerprint_list: List[Optional[Tuple[int, int]]] = []
+	archive_info_list: List[Optional[dict]] = []
+
 	for i, video in enumerate(video_list):
 
-		print()
-		print(f'- Processing the VOD {i+1} of {len(video_list)} "{video.Title}" ({video.HostId} at {video.CreationTime})...')
+		missing_categories = config.categories
+		chat_fingerprint = None
 
 		try:
-			cursor = db.execute('''
-								SELECT
-									CT.Message,
-									CT.Timestamp,
-									CAST((JulianDay(CT.Timestamp) - JulianDay(V.CreationTime)) * 24 * 60 * 60 AS INTEGER) AS Offset
-								FROM Chat CT
-								INNER JOIN Video V ON CT.VideoId = V.Id
-								INNER JOIN Channel CL ON V.ChannelId = CL.Id
-								WHERE V.Id = :video_id
-								ORDER BY CT.Timestamp;
-								''', {'video_id': video.Id})
+			attach_video_chat_shards(i)
+		except (sqlite3.Error, OSError) as error:
+			print(f'Could not attach the chat shards for the video {video.TwitchId} ({video.Title}) with the error: {repr(error)}')
+			return False
 
-		except sqlite3.Error as error:
-			print(f'- Could not retrieve the chat with the error: {repr(error)}')
-			continue
+		if config.cache_frequency:
+			try:
+				with profiler.stage('load cache'):
+					chat_fingerprint = get_chat_fingerprint(video)
+					missing_categories = load_cached_frequency(video, chat_fingerprint)
+			except sqlite3.Error as error:
+				print(f'Could not load the cached message counts for the video {video.TwitchId} ({video.Title}) with the error: {repr(error)}')
 
-		for chat in cursor:
+		# Any categories that weren't cached are counted using the VOD's chat archive, which is created (or updated if the chat changed)
+		# the first time it's needed. The database is used if the archive can't be saved.
+		archive_info = None
 
-			if config.vod_criteria == 'date':
-				assert config.vods_begin_time <= chat['Timestamp'] <= config.vods_end_time, 'The chat message was not sent during the live stream.'
+		if config.chat_archive_path is not None and missing_categories:
+			try:
+				archive_fingerprint = (*get_chat_fingerprint(video), video.UnixCreationTime)
+				archive_info = read_chat_archive_info(config.chat_archive_path, video.TwitchId, archive_fingerprint)
+				
+				if archive_info is None:
+					with profiler.stage('save archive'):
+						archive_info = write_chat_archive(db, config.chat_archive_path, video.Id, video.TwitchId, archive_fingerprint)
+					print(f'Saved the chat archive for the video {video.TwitchId} ({video.Title}).')
 
-			word_list = chat['Message'].lower().split()
-			bucket = floor(chat['Offset'] / config.bucket_length)
+			except (sqlite3.Error, OSError, OverflowError) as error:
+				print(f'Could not save the chat archive for the video {video.TwitchId} ({video.Title}) with the error: {repr(error)}')
 
-			for category in config.categories:
-				
-				skip_to_next_category = False
+		missing_categories_list.append(missing_categories)
+		chat_fingerprint_list.append(chat_fingerprint)
+		archive_info_list.append(archive_info)
 
-				for word in word_list:
-					
-					for search_word in category.search_words:
+	unix_time_range = (config.vods_begin_unix_time, config.vods_end_unix_time) if config.vod_criteria == 'date' else None
 
-						match = False
-						if isinstance(search_word, str):
-							match = (word == search_word)
-						else:
-							match = bool(search_word.match(word))
+	# Each VOD's chat can be counted independently, so we'll start counting all of them in a process pool. The results are
+	# still used in the original order so that the summary doesn't depend on the number of jobs.
+	executor = None
+	frequency_futures: Dict[int, Future] = {}
 
-						if match:
-							video.Frequency[category.name][bucket] += 1
-							skip_to_next_category = True
-							break					
+	# The plots are rendered by a separate pool that is only created if at least one of them has to be saved.
+	plot_futures: List[Tuple[str, Future]] = []
 
-					if skip_to_next_category:
-						break
+	if pools.jobs > 1:
+		executor = pools.get_frequency_executor()
+		for i, (video, missing_categories) in enumerate(zip(video_list, missing_categories_list)):
+			if missing_categories:
+				frequency_futures[i] = executor.submit(count_category_frequency_in_worker, shard_names_list[i], missing_categories, video.Id, video.NumBuckets, config.bucket_length, unix_time_range, use_search_index_list[i], archive_info_list[i])
 
-		if not config.plot_categories:
-			continue
+	for i, video in enumerate(video_list):
 
-		# Plot the word frequency.
-		figure, axes = plt.subplots(figsize=(12, 6))
+		print()
+		print(f'- Processing the VOD {i+1} of {len(video_list)} "{video.Title}" ({video.HostId} at {video.CreationTime})...')
 
-		max_messages = 0
-		for category in config.categories:
+		missing_categories = missing_categories_list[i]
+		chat_fingerprint = chat_fingerprint_list[i]
 
-			if isinstance(config.plot_categories, list) and category.name not in config.plot_categories:
+		if config.cache_frequency and not missing_categories:
+			print('- Loaded the message counts from the cache.')
+
+		if missing_categories:
+
+			if executor is not None:
+				with profiler.stage('wait for workers'):
+					missing_frequency, error_text, profiler_snapshot = frequency_futures.pop(i).result()
+				profiler.merge(profiler_snapshot)
+			else:
+				try:
+					attach_video_chat_shards(i)
+					missing_frequency, error_text = count_category_frequency(db, get_matcher, missing_categories, video.Id, video.NumBuckets, config.bucket_length, unix_time_range, use_search_index_list[i], archive_info_list[i]), None
+				except (sqlite3.Error, OSError, ValueError) as error:
+					missing_frequency, error_text = None, repr(error)
+
+			if missing_frequency is None:
+				print(f'- Could not retrieve the chat with the error: {error_text}')
 				continue
 
-			y_data = video.Frequency[category.name]
-			x_data = [i * config.bucket_length for i in range(len(y_data))]
-			axes.plot(x_data, y_data, label=category.name, color=category.color, linewidth=0.7)
+			video.Frequency[[category.frequency_index for category in missing_categories]] = missing_frequency
 
-			max_messages = max(max_messages, max(y_data))
+			if chat_fingerprint is not None:
+				try:
+					with profiler.stage('save cache'):
+						save_cached_frequency(video, chat_fingerprint, missing_categories)
+				except sqlite3.Error as error:
+					if db.in_transaction:
+						db.execute('ROLLBACK;')
+					print(f'- Could not save the message counts to the cache with the error: {repr(error)}')
 
-		if config.plot_threshold:
-			axes.axhline(y=config.message_threshold, label=f'Threshold ({config.message_threshold})', color='k', linestyle='dashed')
+		if not config.plot_categories:
+			continue
 
-		axes.set(xlabel=f'Time in Buckets of {config.bucket_length} Seconds', ylabel='Number of Messages', title=f'"{video.Title}" ({video.CreationTime}, {video.Duration})\n{video.Url}')
-		axes.legend()
-		
-		# Format the number of seconds as 00h00.
-		def seconds_formatter(num_seconds, position):
-			label, _ = str(timedelta(seconds=num_seconds)).rsplit(':', 1)
-			return label.replace(':', 'h', 1)
-
-		axes.xaxis.set_major_formatter(seconds_formatter)
-		axes.xaxis.set_major_locator(MultipleLocator(30*60 if video.DurationInSeconds >= 90*60 else 15*60))
-		axes.xaxis.set_minor_locator(AutoMinorLocator(4))
-		
-		axes.yaxis.set_major_locator(MultipleLocator(5 if max_messages <= 100 else 10))
+		# Plot the word frequency in a separate process so that it doesn't delay the next VOD. Plots whose data and options
+		# haven't changed since the last run are skipped.
+		plot = {
+			'title': f'"{video.Title}" ({video.CreationTime}, {video.Duration})\n{video.Url}',
+			'bucket_length': config.bucket_length,
+			'duration_in_seconds': video.DurationInSeconds,
+			'message_threshold': config.message_threshold if config.plot_threshold else None,
+			'series': [(category.name, category.color, video.Frequency[category.frequency_index]) for category in config.categories
+					   if not isinstance(config.plot_categories, list) or category.name in config.plot_categories],
+		}
+
+		plot_filename = f'{config.channel_name}_{video.CreationDate}_{video.HostId}.png'
 
-		axes.tick_params(axis='x', which='major', length=7)
-		axes.tick_params(axis='x', which='minor', length=4)
+		with profiler.stage('check plots'):
+			plot_fingerprint = compute_plot_fingerprint(plot)
+			is_plot_unchanged = read_plot_fingerprint(plot_filename) == plot_fingerprint
 
-		axes.set_ylim(-2)
+		if is_plot_unchanged:
+			profiler.count('plots skipped')
+			print(f'- Skipped the plot since "{plot_filename}" is up to date.')
+			continue
 
-		figure.tight_layout()
+		plot_futures.append((plot_filename, pools.get_plot_executor().submit(render_plot, plot_filename, plot, plot_fingerprint)))
 
-		plot_filename = f'{config.channel_name}_{video.CreationDate}_{video.HostId}.png'
-		figure.savefig(plot_filename, dpi=200)
-		print(f'- Saved the plot to "{plot_filename}".')
+	if plot_futures:
+
+		print()
+		print(f'Waiting for {len(plot_futures)} plots to finish rendering...')
+
+		for plot_filename, future in plot_futures:
+			try:
+				with profiler.stage('wait for plots'):
+					future.result()
+				profiler.count('plots rendered')
+				print(f'- Saved the plot to "{plot_filename}".')
+			except (OSError, ValueError) as error:
+				print(f'- Could not save the plot to "{plot_filename}" with the error: {repr(error)}')
 
 	print()
 
@@ -466,24 +1442,25 @@ if __name__ == '__main__':
 	for video in video_list:
 		for comparison in config.comparisons:
 
-			def measure_controversy_1(positive_count: int, negative_count: int) -> float:
-				return (positive_count + negative_count) / (abs(positive_count - negative_count) + 1)
+			positive_frequency = video.Frequency[comparison.positive_category.frequency_index]
+			negative_frequency = video.Frequency[comparison.negative_category.frequency_index]
 
-			def measure_controversy_2(positive_count: int, negative_count: int) -> float:
-				if positive_count == 0 or negative_count == 0:
-					return 0
-				else:
-					return (positive_count + negative_count) ** (min(positive_count, negative_count) / max(positive_count, negative_count))
+			balance = positive_frequency - negative_frequency
+			total = positive_frequency + negative_frequency
 
-			positive_frequency = video.Frequency[comparison.positive_category.name]
-			negative_frequency = video.Frequency[comparison.negative_category.name]
+			# Controversy: the total raised to the ratio between the smaller and larger counts, or zero if either one is zero.
+			smaller_frequency = np.minimum(positive_frequency, negative_frequency)
+			larger_frequency = np.maximum(positive_frequency, negative_frequency)
+			
+			with np.errstate(divide='ignore', invalid='ignore'):
+				controversy = np.where(smaller_frequency > 0, np.power(total.astype(np.float64), smaller_frequency / larger_frequency), 0.0)
 
-			video.Frequency[comparison.positive_name] = [positive_count - negative_count for positive_count, negative_count in zip(positive_frequency, negative_frequency)]
-			video.Frequency[comparison.negative_name] = video.Frequency[comparison.positive_name].copy()
-			video.Frequency[comparison.controversial_name] = [(measure_controversy_2(positive_count, negative_count), positive_count, negative_count) for positive_count, negative_count in zip(positive_frequency, negative_frequency)]
+			video.ComparisonFrequency[comparison.positive_name] = balance
+			video.ComparisonFrequency[comparison.negative_name] = balance
+			video.ComparisonFrequency[comparison.controversial_name] = controversy
 			
 			# We'll use the comparison's name to count the total.
-			video.Frequency[comparison.name] = [positive_count + negative_count for positive_count, negative_count in zip(positive_frequency, negative_frequency)]
+			video.ComparisonFrequency[comparison.name] = total
 
 	for comparison in config.comparisons:
 		for kind in ['positive', 'negative', 'controversial']:
@@ -495,6 +1472,7 @@ if __name__ == '__main__':
 			balance.skip_summary = comparison.skip_summary
 			balance.positive_words = comparison.positive_category.words
 			balance.negative_words = comparison.negative_category.words
+			balance.comparison = comparison
 			balance.comparison_name = comparison.name
 			balance.comparison_kind = kind
 
@@ -517,52 +1495,47 @@ if __name__ == '__main__':
 		
 		is_balance = isinstance(category, CategoryBalance)
 
+		is_controversial = is_balance and category.comparison_kind == 'controversial'
+
 		highlight_candidates = []
-		for video in video_list:
+		with profiler.stage('find candidates'):
+			for video in video_list:
 			
-			# Filter buckets under a certain threshold. For category balance, we use the total number of cases (positive and negative).
-			frequency = video.Frequency[category.name]
-			total = frequency if not is_balance else video.Frequency[category.comparison_name]
+				# Filter buckets under a certain threshold. For category balance, we use the total number of cases (positive and negative).
+				if is_balance:
+					frequency = video.ComparisonFrequency[category.name]
+					total = video.ComparisonFrequency[category.comparison_name]
+				else:
+					frequency = video.Frequency[category.frequency_index]
+					total = frequency
 
-			for i, count in enumerate(total):
-				
-				if count >= config.message_threshold:
-					candidate = Candidate(video, i, frequency[i])
-					highlight_candidates.append(candidate)
+				bucket_list = np.flatnonzero(total >= config.message_threshold).tolist()
+
+				if is_controversial:
+					positive_frequency = video.Frequency[category.comparison.positive_category.frequency_index]
+					negative_frequency = video.Frequency[category.comparison.negative_category.frequency_index]
+					count_list = list(zip(frequency[bucket_list].tolist(), positive_frequency[bucket_list].tolist(), negative_frequency[bucket_list].tolist()))
+				else:
+					count_list = frequency[bucket_list].tolist()
+
+				highlight_candidates.extend(Candidate(video, i, count) for i, count in zip(bucket_list, count_list))
 			
 		# The controversial category balance, the frequency is a tuple with three elements: the controversy metric, the number of positive
 		# messages, and the number of negative ones. This allows us to report the real values in the summary text formatting below, instead
 		# of showing a potentially confusing metric.
-		sort_key = (lambda x: x.Count[0]) if is_balance and category.comparison_kind == 'controversial' else (lambda x: x.Count)
+		sort_key = (lambda x: x.Count[0]) if is_controversial else (lambda x: x.Count)
 		reverse_candidates = (not is_balance or category.comparison_kind != 'negative')
-		highlight_candidates = sorted(highlight_candidates, key=sort_key, reverse=reverse_candidates)
 		
-		# Remove any candidates that occurred too close to each other, starting with the worst ones.
-		# We don't have to do this step if we only want the best candidate, since that one is never
-		# removed from the list.
-		if config.top_bucket_distance_threshold is not None and category.top > 1:
-			
-			num_removed = 0
-			for worse_idx, worse_candidate in reversed(list(enumerate(highlight_candidates))):
-				for better_candidate in highlight_candidates:
-					
-					# Skip the same candidate (since they're the same) and any other future candidates
-					# (since we already compared them in previous iterations of the outer loop).
-					if worse_candidate is better_candidate:
-						break
-
-					worse_video_id = worse_candidate.Video.Id
-					better_video_id = better_candidate.Video.Id
-
-					if worse_video_id == better_video_id and abs(worse_candidate.Bucket - better_candidate.Bucket) < config.top_bucket_distance_threshold:
-						# Remember that, since we're iterating backwards in the outer loop, we're removing
-						# this element from the end of the list.
-						del highlight_candidates[worse_idx]
-						num_removed += 1
-						break
-
-			if num_removed > 0:
-				print(f'- Removed {num_removed} "{category.name}" highlights that were fewer than {config.top_bucket_distance_threshold * config.bucket_length} seconds apart.')
+		# Skip any candidates that occurred too close to better ranked ones. We don't have to do this step if we only want the
+		# best candidate, since that one is never skipped.
+		distance_threshold = config.top_bucket_distance_threshold if category.top > 1 else None
+		with profiler.stage('select highlights'):
+			highlight_candidates, num_skipped = select_top_candidates(highlight_candidates, sort_key, reverse_candidates, category.top, distance_threshold)
+
+		# Only the candidates that are ranked before the top highlights are found are checked, so this isn't the total number of
+		# candidates that are too close to better ones.
+		if num_skipped > 0:
+			print(f'- Skipped {num_skipped} "{category.name}" highlights while selecting the top {category.top} since they were fewer than {config.top_bucket_distance_threshold * config.bucket_length} seconds apart from better ones.')
 		
 		words_summary = ''
 		if config.show_word_list:
@@ -575,8 +1548,6 @@ if __name__ == '__main__':
 		
 		summary_text += f'**{category.name}**{words_summary}:\n\n'
 
-		highlight_candidates = highlight_candidates[:category.top]
-
 		if highlight_candidates:
 
 			for i, candidate in enumerate(highlight_candidates):
@@ -623,5 +1594,60 @@ if __name__ == '__main__':
 
 	print(f'Saved the summary to "{summary_filename}".')
 
+	return True
+
+if __name__ == '__main__':
+
+	parser = ArgumentParser(description='Processes any saved chat messages in the database between two dates, generates a summary text file with the top highlights in different categories, and optionally creates images that plot chat\'s reactions during each live stream.')
+	parser.add_argument('-jobs', type=int, default=1, help='How many worker processes to use when counting the chat messages of each VOD. The results are the same regardless of this number. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-profile', action='store_true', help='Measure the time spent in each stage of the script, then print the results and save them to "highlight_profile.json".')
+	parser.add_argument('-profile-python', action='store_true', help='Also run Python\'s profiler (cProfile) when using -profile and save its results to "highlight_profile.prof".')
+	args = parser.parse_args()
+
+	if args.profile:
+		profiler.start(args.profile_python)
+
+	# Read the configurations file for each channel, connect to the database, and setup the Twitch API.
+
+	config = HighlightConfig()
+	channel_configs = [HighlightConfig(channel_params) for channel_params in config.channels] if config.channels else [config]
+
+	try:
+		db = config.connect_to_database()
+		print(f'Connected to the database: {config.database_path}')
+	except sqlite3.Error as error:
+		print(f'Failed to connect to the database with the error: {repr(error)}')
+		sys.exit(1)
+
+	id_cache = DatabaseIdCache(db)
+
+	# Every channel shares the same database connection, process pools, compiled categories, and Twitch API client.
+	pools = ProcessPools(args.jobs, config.database_path, config.chat_shard_path)
+	video_sources: Dict[Optional[str], Union[HelixVideoSource, JsonVideoSource]] = {}
+	failed_channel_list = []
+
+	try:
+		for i, channel_config in enumerate(channel_configs):
+
+			if config.channels:
+				print()
+				print(f'Generating the highlights for the channel {i+1} of {len(channel_configs)} "{channel_config.channel_name}"...')
+
+			if not generate_highlights(channel_config, db, id_cache, pools, video_sources):
+				failed_channel_list.append(channel_config.channel_name)
+
+	finally:
+		pools.shutdown()
+
+	profiler.finish('highlight')
+
+	if failed_channel_list:
+		
+		if config.channels:
+			print()
+			print(f'Could not generate the highlights for {len(failed_channel_list)} of {len(channel_configs)} channels: ' + ', '.join(failed_channel_list))
+
+		sys.exit(1)
+
 	print()
 	print('Finished running.')
\ No newline at end of file
@@ -1,22 +1,122 @@
 #!/usr/bin/env python3
 
-import json
+import hashlib
+import os
 import sqlite3
 import sys
 from argparse import ArgumentParser
-from datetime import timedelta
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timezone
 from glob import glob
+from itertools import islice
+from typing import Deque, Iterable, Iterator, List, Optional, TextIO, Tuple
 
-from common import CommonConfig, split_twitch_duration, convert_twitch_timestamp_to_datetime
+from common import CommonConfig, ChatLogReader, DatabaseIdCache, WordVocabulary, profiler, attach_chat_shards, encode_word_ids, defer_indexes, find_chat_shards, get_attached_chat_shards, restore_deferred_indexes, split_twitch_duration, convert_twitch_timestamp_to_datetime, convert_datetime_to_unix_time, format_unix_time
+
+def open_chat_log(file: TextIO) -> Tuple[dict, Iterator[dict]]:
+	""" Reads a chat log's VOD metadata and returns it together with an iterator over its chat messages. Raises a ValueError
+	with the reason why the chat log should be skipped. """
+
+	reader = ChatLogReader(file)
+
+	try:
+		chat_log = reader.read_header()
+	except ValueError as error:
+		raise ValueError(f'it could not be parsed: {error}')
+
+	if not reader.in_comments:
+		raise ValueError('it is missing the VOD chat messages')
+
+	chat_iterator: Iterator[dict] = reader.read_comments()
+
+	# The VOD metadata is required to compute the message timestamps. If it only appears after the chat messages
+	# then we have no choice but to keep every message in memory.
+	if 'video' not in chat_log:
+		try:
+			chat_list = list(chat_iterator)
+			chat_log.update(reader.read_trailer())
+		except ValueError as error:
+			raise ValueError(f'it could not be parsed: {error}')
+
+		chat_iterator = iter(chat_list)
+
+	if 'video' not in chat_log:
+		raise ValueError('it is missing the VOD metadata')
+
+	return chat_log['video'], chat_iterator
+
+def parse_video_metadata(video: dict) -> dict:
+	""" Converts a chat log's VOD metadata into the values stored in the Video table. """
+
+	creation_datetime = convert_twitch_timestamp_to_datetime(video['created_at'])
+	hours, minutes, seconds, _ = split_twitch_duration(video['duration'])
+
+	return {
+		'channel_name': video['user_name'].lower(),
+		'twitch_id': video['id'],
+		'title': video['title'],
+		'creation_time': creation_datetime.strftime('%Y-%m-%d %H:%M:%S.%f'),
+		'unix_creation_time': convert_datetime_to_unix_time(creation_datetime),
+		'duration': f'{hours:02}:{minutes:02}:{seconds:02}',
+	}
+
+def prepare_chat_messages(chat_iterator: Iterable[dict], unix_creation_time: int) -> Iterator[tuple]:
+	""" Converts each chat message into the values stored in the Chat table, except for the channel and VOD IDs. """
+
+	for chat in chat_iterator:
+
+		# The "created_at" value doesn't seem to be what we want so we'll compute the timestamp relative to the VOD's creation time.
+		# This is good enough for our purposes even though we're losing precision.
+		video_offset = round(chat['content_offset_seconds'] * 1_000_000)
+		unix_timestamp = unix_creation_time + video_offset
+		timestamp = format_unix_time(unix_timestamp)
+		message = chat['message']['body']
+
+		yield (timestamp, unix_timestamp, video_offset, message)
+
+def prepare_chat_log(file_path: str, encoding: str) -> Tuple[Optional[dict], List[tuple], Optional[str]]:
+	""" Parses a whole chat log in a worker process. Returns its VOD metadata and chat messages, or the reason why it was skipped. """
+
+	try:
+		with open(file_path, encoding=encoding) as file:
+			video, chat_iterator = open_chat_log(file)
+			metadata = parse_video_metadata(video)
+			row_list = list(prepare_chat_messages(chat_iterator, metadata['unix_creation_time']))
+	except (OSError, ValueError, TypeError, AttributeError) as error:
+		return None, [], str(error)
+	except KeyError as error:
+		return None, [], f'it is missing the key {error}'
+
+	return metadata, row_list, None
+
+def compute_file_hash(file_path: str) -> str:
+
+	file_hash = hashlib.sha256()
+	with open(file_path, 'rb') as file:
+		for block in iter(lambda: file.read(1 << 20), b''):
+			file_hash.update(block)
+			profiler.count('bytes hashed', len(block))
+
+	return file_hash.hexdigest()
 
 if __name__ == '__main__':
 
 	parser = ArgumentParser(description='Imports one or more JSON files with a Twitch VOD\'s chat log into the database.')
 	parser.add_argument('search_path', help=r'Where to search for the JSON files. May include wildcards to import multiple files. E.g. "C:\Path\chat.json" or "C:\Path\*.json".')
 	parser.add_argument('encoding', nargs='?', default='utf-8', help='The character encoding used by the JSON files. If omitted, this defaults to "%(default)s". See a list of possible encodings here: https://docs.python.org/3/library/codecs.html#standard-encodings')
-	parser.add_argument('-overwrite', action='store_true', help='Delete any previous chat messages from a Twitch VOD before importing the JSON file.')	
+	parser.add_argument('-overwrite', action='store_true', help='Delete any previous chat messages from a Twitch VOD (including any compacted ones) before importing the JSON file. Implies -force, since every JSON file is imported again.')
+	parser.add_argument('-chunk-size', type=int, default=10000, help='How many chat messages to read and insert at a time. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-bulk', action='store_true', help='Drop the chat indexes and relax the database\'s durability settings while importing, then rebuild the indexes at the end. Useful when importing a large number of chat logs.')
+	parser.add_argument('-force', action='store_true', help='Import every JSON file even if it was previously imported and hasn\'t changed since then. Without -overwrite, importing a VOD that is already in the database fails.')
+	parser.add_argument('-jobs', type=int, default=1, help='How many worker processes to use when parsing the JSON files. The database is still written by a single process. When greater than one, each file is fully parsed in memory before being inserted. If omitted, this defaults to %(default)s.')
+	parser.add_argument('-profile', action='store_true', help='Measure the time spent in each stage of the script, then print the results and save them to "import_profile.json".')
+	parser.add_argument('-profile-python', action='store_true', help='Also run Python\'s profiler (cProfile) when using -profile and save its results to "import_profile.prof".')
 	args = parser.parse_args()
 
+	if args.profile:
+		profiler.start(args.profile_python)
+
 	config = CommonConfig()
 
 	try:
@@ -26,88 +126,308 @@ if __name__ == '__main__':
 		print(f'Failed to connect to the database with the error: {repr(error)}')
 		sys.exit(1)
 
+	# Only this script drops the chat indexes, so any that are still missing are from a previous bulk load that was interrupted.
+	# This isn't done when connecting to the database since other scripts may be running while a bulk load is in progress.
+	try:
+		num_indexes = restore_deferred_indexes(db)
+		if num_indexes > 0:
+			print(f'Rebuilt {num_indexes} chat indexes that were left over from an interrupted bulk load.')
+	except sqlite3.Error as error:
+		print(f'Failed to rebuild the chat indexes left over from an interrupted bulk load with the error: {repr(error)}')
+		sys.exit(1)
+
+	id_cache = DatabaseIdCache(db)
+	vocabulary = WordVocabulary(db)
+
 	file_path_list = glob(args.search_path)
-	for i, file_path in enumerate(file_path_list):
 
-		print()
+	try:
+		cursor = db.execute('SELECT * FROM ImportedFile;')
+		manifest = {row['Path']: row for row in cursor}
+	except sqlite3.Error as error:
+		print(f'Failed to read the import manifest with the error: {repr(error)}')
+		sys.exit(1)
 
-		with open(file_path, encoding=args.encoding) as file:
-			chat_log = json.load(file)
+	def check_manifest(file_path: str) -> Optional[dict]:
+		""" Returns the file information to record in the import manifest, or None if the file is unchanged since it was last imported. """
 
-		if not isinstance(chat_log, dict):
-			print(f'Skipped the chat log in "{file_path}" since it is not a dictionary.')
-			continue
+		absolute_path = os.path.abspath(file_path)
+		stat = os.stat(absolute_path)
+		file_info = {'path': absolute_path, 'size': stat.st_size, 'modification_time': stat.st_mtime_ns, 'hash': None, 'changed': False}
 
-		if 'video' not in chat_log:
-			print(f'Skipped the chat log in "{file_path}" since it is missing the VOD metadata.')
-			continue
+		row = manifest.get(absolute_path)
+		if args.force or args.overwrite or row is None:
+			return file_info
 
-		if 'comments' not in chat_log:
-			print(f'Skipped the chat log in "{file_path}" since it is missing the VOD chat messages.')
-			continue
+		# Only read the file when its size or modification time changed, and then only skip it if its contents are the same.
+		if row['Size'] == stat.st_size and row['ModificationTime'] == stat.st_mtime_ns:
+			return None
+
+		file_info['hash'] = compute_file_hash(absolute_path)
+		if row['Hash'] == file_info['hash']:
+			db.execute('UPDATE ImportedFile SET Size = :size, ModificationTime = :modification_time WHERE Path = :path;', file_info)
+			return None
 
-		video = chat_log['video']
-		chat_list = chat_log['comments']
+		file_info['changed'] = True
+		return file_info
 
-		channel_name = video['user_name'].lower()
-		video_twitch_id = video['id']
-		title = video['title']
+	def record_manifest(file_info: dict, video_twitch_id: str, num_messages: int) -> None:
 
-		creation_datetime = convert_twitch_timestamp_to_datetime(video['created_at'])
-		creation_time = creation_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')
+		if file_info['hash'] is None:
+			with profiler.stage('hash files'):
+				file_info['hash'] = compute_file_hash(file_info['path'])
 
-		hours, minutes, seconds, _ = split_twitch_duration(video['duration'])
-		duration = f'{hours:02}:{minutes:02}:{seconds:02}'
+		db.execute(	'''
+					INSERT OR REPLACE INTO ImportedFile (Path, Size, ModificationTime, Hash, VideoTwitchId, NumMessages, ImportTime)
+					VALUES (:path, :size, :modification_time, :hash, :video_twitch_id, :num_messages, :import_time);
+					''',
+					{**file_info, 'video_twitch_id': video_twitch_id, 'num_messages': num_messages, 'import_time': datetime.now(tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')})
 
-		print(f'Importing the chat log {i+1} of {len(file_path_list)} for the VOD "{title}" ({video_twitch_id} at {creation_time} from "{channel_name}") with {len(chat_list)} messages from "{file_path}"...')
+	def import_chat_log(i: int, file_path: str, file_info: dict, metadata: dict, row_iterator: Iterable[tuple]) -> None:
+		""" Inserts a chat log's VOD and chat messages into the database. """
+
+		channel_name = metadata['channel_name']
+		video_twitch_id = metadata['twitch_id']
+		title = metadata['title']
+		creation_time = metadata['creation_time']
+
+		print(f'Importing the chat log {i+1} of {len(file_path_list)} for the VOD "{title}" ({video_twitch_id} at {creation_time} from "{channel_name}") from "{file_path}"...')
+
+		# Each chat log is imported in a single transaction so that a failure never leaves a VOD partially imported
+		# (including when its previous messages were deleted by -overwrite).
+		def rollback() -> None:
+			if db.in_transaction:
+				db.execute('ROLLBACK;')
+			id_cache.forget_all()
+			vocabulary.forget_all()
+
+		# The messages that were assigned to a VOD that is already in the database may also be in the chat shards that overlap it. These
+		# have to be attached before the transaction begins.
+		if config.chat_shard_path is not None:
+			try:
+				row = db.execute('SELECT UnixCreationTime, Duration FROM Video WHERE TwitchId = :twitch_id;', {'twitch_id': video_twitch_id}).fetchone()
+				shard_names = []
+				
+				if row is not None:
+					*_, duration_in_seconds = split_twitch_duration(row['Duration'])
+					shard_names = find_chat_shards(db, [(row['UnixCreationTime'], row['UnixCreationTime'] + duration_in_seconds * 1_000_000)])
+				
+				attach_chat_shards(db, config.chat_shard_path, shard_names)
+			except (sqlite3.Error, OSError) as error:
+				print(f'- Failed to attach the chat shards with the error: {repr(error)}')
+				return
 
 		try:
-			db.execute('INSERT OR IGNORE INTO Channel (Name) VALUES (:name);', {'name': channel_name})
+			db.execute('BEGIN;')
+			channel_id = id_cache.get_channel_id(channel_name, insert=True)
 		except sqlite3.Error as error:
+			rollback()
 			print(f'- Failed to insert the channel "{channel_name}" with the error: {repr(error)}')
-			continue
+			return
+
+		# A file that changed since it was last imported always replaces its previous messages.
+		overwrite = args.overwrite or file_info['changed']
 
 		try:
+			# Files that were imported before the manifest existed are recorded without being imported again.
+			if not overwrite and file_info['path'] not in manifest and id_cache.get_video_id(video_twitch_id) is not None:
+				cursor = db.execute(	'''
+									SELECT (SELECT COUNT(*) FROM AllChat WHERE VideoId = :video_id) + COALESCE((SELECT NumMessages FROM CompactedChat WHERE VideoId = :video_id), 0);
+									''', {'video_id': id_cache.get_video_id(video_twitch_id)})
+				num_messages = cursor.fetchone()[0]
+				record_manifest(file_info, video_twitch_id, num_messages)
+				db.execute('COMMIT;')
+				print(f'- Recorded the chat log in the import manifest since the VOD is already in the database with {num_messages} messages.')
+				return
+
 			# We want to fail if the VOD is already in the database and -overwrite is not used.
-			modifier = 'OR IGNORE' if args.overwrite else ''
+			modifier = 'OR IGNORE' if overwrite else ''
 
 			db.execute(f'''
-						INSERT {modifier} INTO Video (ChannelId, TwitchId, Title, CreationTime, Duration)
-						VALUES ((SELECT CL.Id FROM Channel CL WHERE CL.Name = :channel_name), :twitch_id, :title, :creation_time, :duration);
+						INSERT {modifier} INTO Video (ChannelId, TwitchId, Title, CreationTime, UnixCreationTime, Duration)
+						VALUES (:channel_id, :twitch_id, :title, :creation_time, :unix_creation_time, :duration);
 						''',
-						{'channel_name': channel_name, 'twitch_id': video_twitch_id, 'title': title, 'creation_time': creation_time, 'duration': duration})
+						{'channel_id': channel_id, **metadata})
+
+			id_cache.forget_video(video_twitch_id)
+			video_id = id_cache.get_video_id(video_twitch_id)
 
-			if args.overwrite:
-				cursor = db.execute('DELETE FROM Chat WHERE VideoId = (SELECT V.Id FROM Video V WHERE V.TwitchId = :twitch_id);', {'twitch_id': video_twitch_id})
-				print(f'- Deleted {cursor.rowcount} messages before importing the chat log.')
+			if overwrite:
+				num_deleted = 0
+				for schema in ['main'] + get_attached_chat_shards(db):
+					cursor = db.execute(f'DELETE FROM {schema}.Chat WHERE VideoId = :video_id;', {'video_id': video_id})
+					num_deleted += cursor.rowcount
+				
+				print(f'- Deleted {num_deleted} messages before importing the chat log.')
+				
+				cursor = db.execute('DELETE FROM CompactedChat WHERE VideoId = :video_id;', {'video_id': video_id})
+				if cursor.rowcount > 0:
+					print('- Deleted the compacted messages before importing the chat log.')
+
+			# Any message counts from previous highlight.py runs are no longer valid.
+			db.execute('DELETE FROM FrequencyCache WHERE VideoId = :video_id;', {'video_id': video_id})
 
 		except sqlite3.Error as error:
+			rollback()
 			print(f'- Failed to insert the VOD with the error: {repr(error)}')
-			continue
+			return
 
-		chat_message_list = []
+		row_iterator = iter(row_iterator)
+		num_messages = 0
 
-		for chat in chat_list:
+		try:
+			while True:
+
+				# When the file is read in chunks, this is also where the JSON file is parsed.
+				with profiler.stage('parse messages'):
+					if config.tokenize_messages:
+						chat_message_list = [(channel_id, video_id, *row, encode_word_ids(vocabulary.get_word_ids(row[3].lower().split()))) for row in islice(row_iterator, args.chunk_size)]
+					else:
+						chat_message_list = [(channel_id, video_id, *row, None) for row in islice(row_iterator, args.chunk_size)]
+				
+				if not chat_message_list:
+					break
+
+				with profiler.stage('insert messages'):
+					db.executemany(	'''
+									INSERT INTO main.Chat (ChannelId, VideoId, Timestamp, UnixTimestamp, VideoOffset, Message, WordIds)
+									VALUES (?, ?, ?, ?, ?, ?, ?);
+									''', chat_message_list)
+
+				num_messages += len(chat_message_list)
+				print(f'- Inserted {num_messages} messages so far...')
+
+			record_manifest(file_info, video_twitch_id, num_messages)
 			
-			# The "created_at" value doesn't seem to be what we want so we'll compute the timestamp relative to the VOD's creation time.
-			# This is good enough for our purposes even though we're losing precision.
-			message_creation_datetime = creation_datetime + timedelta(seconds=chat['content_offset_seconds'])
-			timestamp = message_creation_datetime.strftime('%Y-%m-%d %H:%M:%S.%f')
-			message = chat['message']['body']
+			with profiler.stage('commit'):
+				db.execute('COMMIT;')
+
+		except (sqlite3.Error, OSError, ValueError, KeyError, TypeError) as error:
+			rollback()
+			print(f'- Failed to insert the chat messages after {num_messages} messages with the error: {repr(error)}. No changes were made to the database.')
+		else:
+			profiler.count('files imported')
+			profiler.count('bytes imported', file_info['size'])
+			profiler.count('messages imported', num_messages)
+			print(f'- Finished importing {num_messages} messages.')
 
-			chat_message_list.append({'channel_name': channel_name, 'twitch_id': video_twitch_id, 'timestamp': timestamp, 'message': message})
+	import_list = []
+	num_unchanged = 0
 
+	for i, file_path in enumerate(file_path_list):
+		
 		try:
-			db.executemany(	'''
-							INSERT INTO Chat (ChannelId, VideoId, Timestamp, Message)
-							VALUES ((SELECT CL.Id FROM Channel CL WHERE CL.Name = :channel_name), (SELECT V.Id FROM Video V WHERE V.TwitchId = :twitch_id), :timestamp, :message);
-							''', chat_message_list)
+			with profiler.stage('check files'):
+				file_info = check_manifest(file_path)
+		except (OSError, sqlite3.Error) as error:
+			print()
+			print(f'Skipped the chat log in "{file_path}" since it could not be checked with the error: {repr(error)}')
+			continue
+
+		if file_info is not None:
+			import_list.append((i, file_path, file_info))
+		else:
+			num_unchanged += 1
+
+	if num_unchanged > 0:
+		print()
+		print(f'Skipped {num_unchanged} chat logs that haven\'t changed since they were last imported.')
+
+	# For large backfills, it's faster to rebuild the Chat indexes once at the end than to update them for every message.
+	# The indexes are restored even if the import is interrupted (or the next time this script runs). The VideoId index
+	# is kept since each file looks up (and with -overwrite deletes) its VOD's previous messages, which would otherwise
+	# scan the whole table. Since each VOD's messages are inserted in timestamp order, updating it is cheap anyway.
+	bulk = args.bulk and len(import_list) > 0
+
+	if bulk:
+		try:
+			db.execute('PRAGMA synchronous = OFF;')
+			db.execute(f'PRAGMA cache_size = -{256 * 1024};')
+			num_indexes = defer_indexes(db, 'Chat', ['ChatVideoIndex'])
+			print(f'Dropped {num_indexes} chat indexes for the bulk load.')
 		except sqlite3.Error as error:
-			print(f'- Failed to insert the chat messages with the error: {repr(error)}')
-		
+			print(f'Failed to prepare the database for the bulk load with the error: {repr(error)}')
+			sys.exit(1)
+
+	try:
+		if args.jobs > 1:
+
+			# Parse the files in a process pool while this process inserts the results in the original order. Only a limited number
+			# of files is parsed ahead of the writer so that the memory usage stays bounded.
+			with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+
+				pending_futures: Deque[Tuple[int, str, dict, Future]] = deque()
+				next_index = 0
+
+				while next_index < len(import_list) or pending_futures:
+
+					while next_index < len(import_list) and len(pending_futures) < 2 * args.jobs:
+						i, file_path, file_info = import_list[next_index]
+						pending_futures.append((i, file_path, file_info, executor.submit(prepare_chat_log, file_path, args.encoding)))
+						next_index += 1
+
+					i, file_path, file_info, future = pending_futures.popleft()
+					
+					with profiler.stage('wait for workers'):
+						metadata, row_list, skip_reason = future.result()
+
+					print()
+
+					if metadata is None:
+						print(f'Skipped the chat log in "{file_path}" since {skip_reason}.')
+						continue
+
+					import_chat_log(i, file_path, file_info, metadata, row_list)
+					del row_list
+
+		else:
+
+			for i, file_path, file_info in import_list:
+
+				print()
+
+				# The chat messages are read and inserted in chunks so that the memory usage doesn't depend on the file size.
+				try:
+					file = open(file_path, encoding=args.encoding)
+				except OSError as error:
+					print(f'Skipped the chat log in "{file_path}" since {error}.')
+					continue
+
+				with file:
+
+					try:
+						video, chat_iterator = open_chat_log(file)
+						metadata = parse_video_metadata(video)
+					except (OSError, ValueError, TypeError, AttributeError) as error:
+						print(f'Skipped the chat log in "{file_path}" since {error}.')
+						continue
+					except KeyError as error:
+						print(f'Skipped the chat log in "{file_path}" since it is missing the key {error}.')
+						continue
+
+					import_chat_log(i, file_path, file_info, metadata, prepare_chat_messages(chat_iterator, metadata['unix_creation_time']))
+
+	finally:
+		if bulk:
+			if db.in_transaction:
+				db.execute('ROLLBACK;')
+
+			print()
+			print('Rebuilding the chat indexes after the bulk load...')
+
+			with profiler.stage('rebuild indexes'):
+				num_indexes = restore_deferred_indexes(db)
+				db.execute('PRAGMA optimize;')
+			db.execute('PRAGMA cache_size = -2000;')
+			db.execute('PRAGMA synchronous = NORMAL;')
+
+			print(f'Rebuilt {num_indexes} chat indexes.')
+
 	if not file_path_list:
 		print()
 		print(f'Could not find any chat logs in "{args.search_path}".')
 
+	profiler.finish('import')
+
 	print()
 	print('Finished running.')
\ No newline at end of file